@@ -0,0 +1,42 @@
+"""Compares two benchmark reports, e.g. from before and after a change:
+
+    python -m benchmarks.compare base.json head.json
+
+Ratios are head / base, so below 1 is faster for times and above 1 is faster for fps.
+"""
+import json
+import sys
+
+
+def ratio(base, head):
+    return f"{head / base:.2f}x" if base else "-"
+
+
+def compare(base, head):
+    lines = [f"base {(base.get('commit') or '?')[:10]}  head {(head.get('commit') or '?')[:10]}"]
+    if base.get("config") != head.get("config"):
+        lines.append("warning: the reports were run with different configs")
+    for target, h in head["results"].items():
+        b = base["results"].get(target)
+        if not b or "failed" in b or "failed" in h:
+            lines.append(f"\n{target}: not comparable")
+            continue
+        lines.append(f"\n{target}")
+        lines.append(f"  wall_s       {b['wall_s']:>10} {h['wall_s']:>10}  {ratio(b['wall_s'], h['wall_s'])}")
+        lines.append(f"  video_fps    {b['video_fps']:>10} {h['video_fps']:>10}  {ratio(b['video_fps'], h['video_fps'])}")
+        lines.append(f"  peak_rss_mb  {b['peak_rss_mb']:>10} {h['peak_rss_mb']:>10}  "
+                     f"{ratio(b['peak_rss_mb'], h['peak_rss_mb'])}")
+        for service, stages in h["stages"].items():
+            for name, s in stages.items():
+                before = b["stages"].get(service, {}).get(name)
+                if before:
+                    lines.append(f"  {service}/{name} mean_ms".ljust(40)
+                                 + f"{before['mean_ms']:>10} {s['mean_ms']:>10}  {ratio(before['mean_ms'], s['mean_ms'])}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        raise SystemExit("usage: python -m benchmarks.compare base.json head.json")
+    with open(sys.argv[1]) as f1, open(sys.argv[2]) as f2:
+        print(compare(json.load(f1), json.load(f2)))
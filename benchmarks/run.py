@@ -0,0 +1,279 @@
+"""Benchmark harness: runs each analyzer's /analyze/ path and the orchestrator's /process/
+end to end on a synthetic video, and writes a JSON report (wall time, frames per second,
+per-stage latency from common.metrics, peak RSS) that can be compared across commits with
+benchmarks/compare.py.
+
+    python -m benchmarks.run --seconds 60 --people 20 --faces 4 --out bench.json
+    python -m benchmarks.run --targets crowd,orchestrator --models real
+
+Every target runs in its own process, so peak RSS and model loading are measured per target.
+With `--models stub` (the default) the models are replaced by stand-ins (see stubs.py), which
+measures everything around the models: decoding, sampling, batching, aggregation, uploads.
+Apps are called in-process through ASGI transports, so in the orchestrator run the four
+services share one process and event loop.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import cached_video
+
+# target -> (service directory, module, port the orchestrator calls it on)
+SERVICES = {
+    "crowd": ("crowd_service", "crowd_analyser", 8100),
+    "environment": ("env_service", "envir_analyzer", 8200),
+    "emotion": ("emotion_service", "emo_analyzer", 8300),
+    "posture": ("body_service", "body_analyzer", 8400),
+}
+TARGETS = tuple(SERVICES) + ("orchestrator",)
+
+
+def import_service(target):
+    directory, module, _ = SERVICES[target]
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    module = importlib.import_module(module)
+    # Apps called through ASGITransport never get their startup event, which is what
+    # starts loading the models
+    module.models.ensure()
+    return module
+
+
+def metrics_snapshot():
+    from common.metrics import STAGE_SECONDS, FRAMES
+    with STAGE_SECONDS.lock:
+        stages = {key: (total, n) for key, (_, total, n) in STAGE_SECONDS.values.items()}
+    with FRAMES.lock:
+        frames = dict(FRAMES.values)
+    return stages, frames
+
+
+def stage_report(before, after):
+    report = {}
+    for (service, stage), (total, n) in sorted(after.items()):
+        total0, n0 = before.get((service, stage), (0.0, 0))
+        if n > n0:
+            report.setdefault(service, {})[stage] = {
+                "count": n - n0,
+                "total_s": round(total - total0, 4),
+                "mean_ms": round(1000 * (total - total0) / (n - n0), 3),
+            }
+    return report
+
+
+def find_errors(result, path=""):
+    """Every "error" value anywhere in a service or orchestrator response."""
+    if isinstance(result, dict):
+        found = [f"{path or '/'}: {result['error']}"] if "error" in result and isinstance(result["error"], str) else []
+        for key, value in result.items():
+            found += find_errors(value, f"{path}/{key}")
+        return found
+    return []
+
+
+async def post_video(app, url, video_path, data=None):
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        with open(video_path, "rb") as f:
+            files = {"file": (os.path.basename(video_path), f, "video/mp4")}
+            resp = await client.post(url, files=files, data=data, timeout=None)
+        resp.raise_for_status()
+        return resp.json()
+
+
+def service_router(apps):
+    """httpx transport sending each request to the in-process app listening on its port."""
+    import httpx
+
+    class ServiceRouter(httpx.AsyncBaseTransport):
+        def __init__(self):
+            self.transports = {port: httpx.ASGITransport(app=app) for port, app in apps.items()}
+
+        async def handle_async_request(self, request):
+            return await self.transports[request.url.port].handle_async_request(request)
+
+    return ServiceRouter()
+
+
+def load_orchestrator(workdir):
+    apps = {SERVICES[t][2]: import_service(t).app for t in SERVICES}
+    os.environ.setdefault("GEMINI_BACKEND", "stub")
+    os.environ["RESULT_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["SHARED_UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    # result_*.json files are written relative to the working directory
+    os.makedirs(os.path.join(workdir, "outputs"), exist_ok=True)
+    os.chdir(workdir)
+    path = os.path.join(ROOT, "orchestrator")
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return importlib.import_module("app"), apps
+
+
+async def bench_orchestrator(orchestrator, apps, video_path):
+    import httpx
+    await orchestrator.startup()
+    await orchestrator.http_client.aclose()
+    orchestrator.http_client = httpx.AsyncClient(transport=service_router(apps))
+    graph_dir = None
+    try:
+        result = await post_video(orchestrator.app, "/process/", video_path, {"context": "benchmark"})
+        # Graphs are only drawn when first requested
+        transport = httpx.ASGITransport(app=orchestrator.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in ("crowd_graph", "environment_graph"):
+                (await client.get("/" + result["graphs"][name])).raise_for_status()
+        graph_dir = os.path.join(orchestrator.graphs_path, result["graphs"]["crowd_graph"].split("/")[1])
+        return result
+    finally:
+        await orchestrator.shutdown()
+        if graph_dir:
+            shutil.rmtree(graph_dir, ignore_errors=True)
+
+
+def run_single(target, video_path, video_frames):
+    """Benchmarks one target in this process and returns its report entry."""
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    cwd = os.getcwd()
+    try:
+        start = time.perf_counter()
+        if target == "orchestrator":
+            orchestrator, apps = load_orchestrator(workdir)
+            run = lambda: bench_orchestrator(orchestrator, apps, video_path)
+        else:
+            app = import_service(target).app
+            run = lambda: post_video(app, "/analyze/", video_path)
+        startup = time.perf_counter() - start
+
+        stages_before, frames_before = metrics_snapshot()
+        start = time.perf_counter()
+        result = asyncio.run(run())
+        wall = time.perf_counter() - start
+        stages_after, frames_after = metrics_snapshot()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    frames = {key[0]: n - frames_before.get(key, 0) for key, n in frames_after.items()}
+    return {
+        "startup_s": round(startup, 3),
+        "wall_s": round(wall, 3),
+        "video_frames": video_frames,
+        "video_fps": round(video_frames / wall, 2),
+        "frames_analyzed": frames,
+        "analyzed_fps": {service: round(n / wall, 2) for service, n in frames.items()},
+        "stages": stage_report(stages_before, stages_after),
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "errors": find_errors(result),
+    }
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return rev or None, dirty
+    except OSError:
+        return None, None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default=",".join(TARGETS), help="comma separated, from " + ", ".join(TARGETS))
+    parser.add_argument("--models", choices=("stub", "real"), default="stub")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="simulated inference time per frame for the stub models")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--people", type=int, default=20, help="mean people per frame")
+    parser.add_argument("--faces", type=int, default=4, help="mean faces per frame")
+    parser.add_argument("--scene-change", type=float, default=20, help="seconds between lighting changes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="report path (default: print to stdout)")
+    parser.add_argument("--single", choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument("--video", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    video_frames = int(args.seconds * args.fps)
+
+    if args.single:
+        if args.models == "stub":
+            from benchmarks import stubs
+            stubs.install(people=args.people, faces=args.faces, latency_ms=args.latency_ms, seed=args.seed)
+        result = run_single(args.single, args.video, video_frames)
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return
+
+    targets = [t for t in args.targets.split(",") if t]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        raise SystemExit(f"Unknown targets: {', '.join(sorted(unknown))}")
+
+    video = cached_video(seconds=args.seconds, fps=args.fps, width=args.width, height=args.height,
+                         people=args.people, faces=args.faces, scene_change_seconds=args.scene_change,
+                         seed=args.seed)
+    results = {}
+    for target in targets:
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            result_file = tmp.name
+        cmd = [sys.executable, "-m", "benchmarks.run", "--single", target, "--video", video,
+               "--result-file", result_file, "--models", args.models, "--latency-ms", str(args.latency_ms),
+               "--seconds", str(args.seconds), "--fps", str(args.fps), "--people", str(args.people),
+               "--faces", str(args.faces), "--seed", str(args.seed)]
+        print(f"Benchmarking {target}...", file=sys.stderr)
+        proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True)
+        try:
+            if proc.returncode != 0:
+                results[target] = {"failed": proc.stderr.strip().splitlines()[-20:]}
+            else:
+                with open(result_file) as f:
+                    results[target] = json.load(f)
+        finally:
+            os.remove(result_file)
+
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("single", "video", "result_file", "out")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
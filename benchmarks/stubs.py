@@ -0,0 +1,167 @@
+"""Lightweight stand-ins for the models, so the services run on a machine without the model
+files or the heavy model libraries. Only ever installed by the benchmark harness.
+
+- ultralytics.YOLO: person boxes (crowd) and pose keypoints (posture) at random positions.
+- keras load_model: a single dense layer over the 48x48 face crop.
+- cv2.CascadeClassifier: runs the real Haar cascade (so its cost is kept), then reports
+  synthetic, slowly moving faces.
+- torch.load / joblib.load of a missing model file: randomly initialised weights, or a random
+  forest fit on synthetic zone features. Model files that exist are loaded as usual.
+
+`latency_ms` adds a sleep per frame to YOLO and per batch to the face model, to stand in
+for the inference time of the real models.
+"""
+import os
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+
+SKELETON = np.array([
+    [0, -80], [-5, -85], [5, -85], [-10, -82], [10, -82],  # nose, eyes, ears
+    [-20, -60], [20, -60], [-30, -30], [30, -30], [-32, 0], [32, 0],  # shoulders, elbows, wrists
+    [-12, 0], [12, 0], [-14, 45], [14, 45], [-15, 90], [15, 90],  # hips, knees, ankles
+], dtype=np.float32)
+
+
+class _Tracks:
+    """Positions of n things drifting across a frame, one step per call."""
+
+    def __init__(self, n, rng):
+        self.rng = rng
+        self.pos = rng.uniform(0, 1, (n, 2))
+        self.vel = rng.normal(0, 0.002, (n, 2))
+
+    def step(self, n_visible):
+        self.pos = (self.pos + self.vel) % 1.0
+        return self.pos[:n_visible]
+
+
+def _visible(rng, mean):
+    return int(min(rng.poisson(mean), mean * 2)) if mean else 0
+
+
+class StubYOLO:
+    def __init__(self, weights=None, *args, **kwargs):
+        self.rng = np.random.default_rng(STUB["seed"])
+        self.people = _Tracks(STUB["people"] * 2 + 1, self.rng)
+
+    def _sleep(self, n_frames):
+        if STUB["latency_ms"]:
+            time.sleep(STUB["latency_ms"] * n_frames / 1000)
+
+    def __call__(self, frames, verbose=False, **kwargs):
+        import torch
+        self._sleep(len(frames))
+        results = []
+        for frame in frames:
+            h, w = frame.shape[:2]
+            xy = self.people.step(_visible(self.rng, STUB["people"])) * [w, h]
+            boxes = np.hstack([xy, xy + [w / 40, h / 12]]).astype(np.float32)
+            results.append(types.SimpleNamespace(boxes=types.SimpleNamespace(
+                xyxy=torch.from_numpy(boxes), cls=torch.zeros(len(boxes)),
+            )))
+        return results
+
+    def predict(self, source=None, **kwargs):
+        import torch
+        self._sleep(1)
+        h, w = source.shape[:2]
+        centers = self.people.step(_visible(self.rng, STUB["people"])) * [w, h]
+        if not len(centers):
+            return [types.SimpleNamespace(keypoints=None)]
+        kpts = centers[:, None, :] + SKELETON[None] * (h / 400) \
+            + self.rng.normal(0, 3, (len(centers), len(SKELETON), 2))
+        kpts[self.rng.uniform(size=kpts.shape[:2]) < 0.05] = 0  # undetected keypoints
+        return [types.SimpleNamespace(keypoints=_Keypoints(torch.from_numpy(kpts.astype(np.float32))))]
+
+
+class _Keypoints:
+    def __init__(self, xy):
+        self.xy = xy
+
+    def __len__(self):
+        return len(self.xy)
+
+
+class StubCascade:
+    def __init__(self, path):
+        self.cascade = _real_cascade(path)
+        self.rng = np.random.default_rng(STUB["seed"] + 1)
+        self.faces = _Tracks(STUB["faces"] * 2 + 1, self.rng)
+
+    def detectMultiScale(self, gray, *args, **kwargs):
+        self.cascade.detectMultiScale(gray, *args, **kwargs)
+        h, w = gray.shape[:2]
+        size = max(30, w // 25)
+        xy = (self.faces.step(_visible(self.rng, STUB["faces"])) * [w - size, h - size]).astype(int)
+        return np.array([[x, y, size, size] for x, y in xy]).reshape(-1, 4)
+
+
+class StubEmotionModel:
+    def __init__(self):
+        self.weights = np.random.default_rng(STUB["seed"]).normal(0, 0.05, (48 * 48, 7)).astype(np.float32)
+
+    def predict_on_batch(self, x):
+        if STUB["latency_ms"]:
+            time.sleep(STUB["latency_ms"] / 1000)
+        logits = x.reshape(len(x), -1) @ self.weights
+        e = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+
+
+def stub_zone_classifier(seed=0):
+    """Random forest over [people, density, clusters] with the calm/chaotic states the crowd
+    insights look for."""
+    from sklearn.ensemble import RandomForestClassifier
+    rng = np.random.default_rng(seed)
+    people = rng.integers(0, 15, 2000)
+    X = np.column_stack([people, people / 25000, rng.integers(0, 4, 2000)])
+    y = np.select([people < 3, people < 8], ["calm", "normal"], "chaotic")
+    return RandomForestClassifier(n_estimators=100, random_state=seed).fit(X, y)
+
+
+STUB = {"people": 20, "faces": 4, "latency_ms": 0.0, "seed": 0}
+_real_cascade = cv2.CascadeClassifier
+
+
+def install(people=20, faces=4, latency_ms=0.0, seed=0):
+    """Patches the stand-ins in. Must run before the service modules are imported."""
+    STUB.update(people=people, faces=faces, latency_ms=latency_ms, seed=seed)
+
+    sys.modules["ultralytics"] = types.SimpleNamespace(YOLO=StubYOLO)
+    keras = types.ModuleType("keras")
+    keras.models = types.SimpleNamespace(load_model=lambda path, *a, **k: StubEmotionModel())
+    sys.modules["keras"] = keras
+    sys.modules["keras.models"] = keras.models
+    cv2.CascadeClassifier = StubCascade
+
+    import joblib
+    real_joblib_load = joblib.load
+
+    def joblib_load(path, *args, **kwargs):
+        if isinstance(path, (str, os.PathLike)) and not os.path.exists(path):
+            return stub_zone_classifier(seed)
+        return real_joblib_load(path, *args, **kwargs)
+
+    joblib.load = joblib_load
+
+    import torch
+    real_torch_load = torch.load
+    real_load_state_dict = torch.nn.Module.load_state_dict
+
+    def torch_load(path, *args, **kwargs):
+        if isinstance(path, (str, os.PathLike)) and not os.path.exists(path):
+            return None
+        return real_torch_load(path, *args, **kwargs)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        if state_dict is None:
+            return None  # keep the random initial weights
+        return real_load_state_dict(self, state_dict, *args, **kwargs)
+
+    torch.manual_seed(seed)
+    torch.load = torch_load
+    torch.nn.Module.load_state_dict = load_state_dict
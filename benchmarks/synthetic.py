@@ -0,0 +1,62 @@
+"""Synthetic surveillance-like test videos.
+
+The content is only meant to exercise the pipelines (decoding, sampling, scene changes,
+encoding of frame batches), not to be recognisable by the real models: with stand-in models
+(see stubs.py) the number of people and faces "detected" comes from the same settings.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+
+def video_params(seconds=60, fps=30, width=1280, height=720, people=20, faces=4,
+                 scene_change_seconds=20, seed=0):
+    return {
+        "seconds": seconds, "fps": fps, "width": width, "height": height, "people": people,
+        "faces": faces, "scene_change_seconds": scene_change_seconds, "seed": seed,
+    }
+
+
+def make_video(path, seconds=60, fps=30, width=1280, height=720, people=20, faces=4,
+               scene_change_seconds=20, seed=0):
+    """Writes an mp4 of moving "people" (dark boxes) and "faces" (light ellipses) over a noisy
+    background whose lighting changes every `scene_change_seconds`."""
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open video writer for {path}")
+
+    background = rng.integers(60, 120, (height, width, 3), dtype=np.uint8)
+    pos = rng.uniform([0, 0], [width, height], (people + faces, 2))
+    vel = rng.normal(0, 2, (people + faces, 2))
+    box_w, box_h = max(8, width // 40), max(16, height // 12)
+    try:
+        for i in range(int(seconds * fps)):
+            scene = int(i / (fps * scene_change_seconds)) if scene_change_seconds else 0
+            frame = cv2.add(background, np.full_like(background, (scene * 37) % 100))
+            pos = (pos + vel) % [width, height]
+            for x, y in pos[:people].astype(int):
+                cv2.rectangle(frame, (x, y), (x + box_w, y + box_h), (30, 30, 30), -1)
+            for x, y in pos[people:].astype(int):
+                cv2.ellipse(frame, (x, y), (box_w, int(box_w * 1.3)), 0, 0, 360, (190, 200, 220), -1)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def cached_video(directory=None, **params):
+    """Path of a video with these parameters, generated on first use."""
+    params = video_params(**params)
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    directory = directory or os.path.join(tempfile.gettempdir(), "surveillance_bench")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"synthetic_{key}.mp4")
+    if not os.path.exists(path):
+        make_video(path + ".tmp.mp4", **params)
+        os.replace(path + ".tmp.mp4", path)
+    return path
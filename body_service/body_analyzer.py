@@ -1,15 +1,24 @@
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.middleware.cors import CORSMiddleware
-from ultralytics import YOLO
 import pandas as pd
 import joblib
-import cv2
 import json
-import tempfile
 import os
+import asyncio
+import sys
+import threading
 import numpy as np
+from collections import Counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.frames import SCHEDULES
+from common.uploads import received_file
+from common.segments import SegmentPool, source_info, iter_source
+from common.metrics import instrument, stage, timed_frames, ITEMS
+from common.readiness import ModelLoader, add_probes
 
 app = FastAPI(title="Body Posture and Language Analysis API")
+instrument(app, "posture")
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,107 +29,209 @@ app.add_middleware(
 )
 
 BASE_DIR = os.path.dirname(__file__)
-posture_model = joblib.load(os.path.join(BASE_DIR, "posture_rf_model.pkl"))
-bodylang_model = joblib.load(os.path.join(BASE_DIR, "body_language_rf_model.pkl"))
-yolo_model = YOLO("yolov8n-pose.pt")
+# Loaded by load_models, ultralytics (and torch) is only imported then
+posture_model = bodylang_model = yolo_model = None
+# The YOLO predictor keeps per-call state, threads analyzing videos in-process (orchestrator
+# edge mode) take turns with it
+yolo_lock = threading.Lock()
+
+# Worker processes analyzing segments of one video in parallel (1 = off), each with its own models
+SEGMENTS = int(os.getenv("BODY_SEGMENTS", "1"))
 
 feature_cols = ['torso_angle_deg', 'head_angle_deg', 'left_knee_angle_deg', 'right_knee_angle_deg']
 
 outputs_dir = os.path.join(BASE_DIR, "outputs")
 os.makedirs(outputs_dir, exist_ok=True)
 
-def extract_features_from_keypoints(kpts):
+# COCO keypoint indices
+NOSE = 0
+L_SHOULDER, R_SHOULDER = 5, 6
+L_HIP, R_HIP = 11, 12
+L_KNEE, R_KNEE = 13, 14
+L_ANKLE, R_ANKLE = 15, 16
+
+# Used for an angle whose keypoints were not detected: upright torso and head, straight knees
+DEFAULT_FEATURES = np.array([0.0, 0.0, 180.0, 180.0])
+
+
+def load_models():
+    global posture_model, bodylang_model, yolo_model
+    from ultralytics import YOLO
+    posture_model = joblib.load(os.path.join(BASE_DIR, "posture_rf_model.pkl"))
+    bodylang_model = joblib.load(os.path.join(BASE_DIR, "body_language_rf_model.pkl"))
+    # Next to the service, not in whatever directory it was started from (ultralytics
+    # downloads it there when it is missing)
+    yolo_model = YOLO(os.path.join(BASE_DIR, "yolov8n-pose.pt"))
+
+
+def warm_up():
+    yolo_model.predict(source=np.zeros((640, 640, 3), dtype=np.uint8), imgsz=640, conf=0.25, device='cpu',
+                       verbose=False)
+    features_df = pd.DataFrame([DEFAULT_FEATURES], columns=feature_cols)
+    posture_model.predict(features_df)
+    bodylang_model.predict(features_df)
 
-    return {
-        'torso_angle_deg': 100.0,
-        'head_angle_deg': 90.0,
-        'left_knee_angle_deg': 170.0,
-        'right_knee_angle_deg': 175.0
-    }
+
+models = ModelLoader("posture", load_models, warm_up)
+add_probes(app, models)
+
+
+def angle_from_vertical(start, end):
+    """Angle in degrees between the start->end vectors and straight up (0 upright, 90 horizontal)."""
+    d = end - start
+    return np.degrees(np.arctan2(np.abs(d[:, 0]), -d[:, 1]))
+
+
+def joint_angle(a, joint, b):
+    """Inner angle in degrees at `joint` between joint->a and joint->b (180 = straight limb)."""
+    u, v = a - joint, b - joint
+    cos = np.sum(u * v, axis=1) / (np.linalg.norm(u, axis=1) * np.linalg.norm(v, axis=1))
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+def extract_features_from_keypoints(kpts):
+    """Turns an (N, 17, 2) array of keypoints for N people into an (N, 4) matrix of
+    feature_cols, for all people at once."""
+    kpts = np.asarray(kpts, dtype=float)
+    # YOLO reports keypoints it could not find as (0, 0)
+    kpts = np.where((kpts == 0).all(axis=-1, keepdims=True), np.nan, kpts)
+    shoulders = (kpts[:, L_SHOULDER] + kpts[:, R_SHOULDER]) / 2
+    hips = (kpts[:, L_HIP] + kpts[:, R_HIP]) / 2
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        feats = np.column_stack([
+            angle_from_vertical(hips, shoulders),
+            angle_from_vertical(shoulders, kpts[:, NOSE]),
+            joint_angle(kpts[:, L_HIP], kpts[:, L_KNEE], kpts[:, L_ANKLE]),
+            joint_angle(kpts[:, R_HIP], kpts[:, R_KNEE], kpts[:, R_ANKLE]),
+        ])
+    return np.where(np.isnan(feats), DEFAULT_FEATURES, feats)
 
 
 def analyze_frame(frame):
-    results = yolo_model.predict(source=frame, imgsz=640, conf=0.25, device='cpu')
+    """Returns the (N, 4) feature matrix of the people in the frame, or None if there are none."""
+    with stage("posture", "pose"), yolo_lock:
+        results = yolo_model.predict(source=frame, imgsz=640, conf=0.25, device='cpu')
     r = results[0]
-    if len(r.keypoints) == 0:
+    if r.keypoints is None or len(r.keypoints) == 0:
         return None
 
     kpts_array = r.keypoints.xy.cpu().numpy()
-    person_kpts = kpts_array[0]
-    features = extract_features_from_keypoints(person_kpts)
-
-    features_df = pd.DataFrame([features], columns=feature_cols)
-    posture_pred = posture_model.predict(features_df)[0]
-    bodylang_pred = bodylang_model.predict(features_df)[0]
-
+    ITEMS.inc(len(kpts_array), service="posture", item="persons")
+    with stage("posture", "features"):
+        return extract_features_from_keypoints(kpts_array)
+
+
+def most_common(values):
+    return Counter(values).most_common(1)[0][0]
+
+
+def analyze_people(frames):
+    """Posture and body language of every person in already sampled (frame_idx, frame) pairs,
+    per frame. Frames without anyone in them are left out."""
+    frame_idxs = []
+    frame_feats = []
+    for frame_idx, frame in timed_frames(frames, "posture"):
+        feats = analyze_frame(frame)
+        if feats is not None:
+            frame_idxs.append(frame_idx)
+            frame_feats.append(feats)
+
+    if not frame_feats:
+        return []
+
+    # Everyone in the video goes through each classifier in a single call
+    features_df = pd.DataFrame(np.concatenate(frame_feats), columns=feature_cols)
+    with stage("posture", "classification"):
+        postures = posture_model.predict(features_df).tolist()
+        bodylangs = bodylang_model.predict(features_df).tolist()
+
+    frame_results = []
+    start = 0
+    for frame_idx, feats in zip(frame_idxs, frame_feats):
+        end = start + len(feats)
+        frame_results.append({
+            "frame": frame_idx,
+            "persons": [
+                {"posture": p, "body_language": b}
+                for p, b in zip(postures[start:end], bodylangs[start:end])
+            ],
+        })
+        start = end
+    return frame_results
+
+
+def summarize(frame_results):
+    if not frame_results:
+        return {"error": "No persons detected in any frames."}
+
+    postures = [p["posture"] for f in frame_results for p in f["persons"]]
+    bodylangs = [p["body_language"] for f in frame_results for p in f["persons"]]
     return {
-        "posture": posture_pred,
-        "body_language": bodylang_pred
+        "frames_analyzed": len(frame_results),
+        "persons_analyzed": len(postures),
+        "frame_results": frame_results,
+        "aggregated_posture_bodylang": {
+            "posture": most_common(postures),
+            "body_language": most_common(bodylangs)
+        }
     }
 
 
-@app.post("/analyze/")
-async def analyze(file: UploadFile):
-    suffix = os.path.splitext(file.filename)[-1] or ".mp4"
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        while True:
-            chunk = await file.read(1024 * 1024)
-            if not chunk:
-                break
-            tmp.write(chunk)
-        tmp.flush()
-        tmp_path = tmp.name
+def analyze_frames(frames):
+    return summarize(analyze_people(frames))
+
+
+def analyze_segment(source, start, stop):
+    """Runs in a segment worker process."""
+    return analyze_people(iter_source(source, SCHEDULES["posture"], start, stop))
+
+
+segment_pool = SegmentPool(SEGMENTS, __name__, {"BODY_SEGMENTS": "1", "OMP_NUM_THREADS": "1"})
+
+
+async def analyze_source(source):
+    """Analyzes a video or frame batch, in parallel segments when enabled and long enough.
+    Segments are concatenated in order, so the aggregate is the same as in one piece."""
+    await models.wait()
+    fps, length = source_info(source)
+    segments = segment_pool.segments(length, fps) if segment_pool.enabled else [(0, None)]
+    if len(segments) == 1:
+        # one frame every 5 seconds, off the event loop so /ready and /metrics still answer
+        return await asyncio.to_thread(analyze_frames, iter_source(source, SCHEDULES["posture"]))
+    parts = await segment_pool.run(analyze_segment, [(source, start, stop) for start, stop in segments])
+    return summarize([r for part in parts for r in part])
+
+
+@app.on_event("startup")
+def startup():
+    segment_pool.start()
 
+
+@app.on_event("shutdown")
+def shutdown():
+    segment_pool.shutdown()
+
+
+@app.post("/analyze/")
+async def analyze(file: UploadFile = File(None), path: str = Form(None)):
+    """Takes an uploaded video, or the `path` of one in SHARED_UPLOAD_DIR."""
     try:
-        if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
-            raise ValueError(f"Uploaded video file is empty: {tmp_path}")
-
-        cap = cv2.VideoCapture(tmp_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {tmp_path}")
-
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        if fps == 0 or np.isnan(fps):
-            fps = 30
-        frame_interval = int(fps * 5)  # one frame every 5 seconds
-
-        frame_idx = 0
-        frame_results = []
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if frame_idx % frame_interval == 0:
-                preds = analyze_frame(frame)
-                if preds:
-                    frame_results.append(preds)
-            frame_idx += 1
-
-        cap.release()
-        if frame_results:
-            posture_modes = [r["posture"] for r in frame_results]
-            body_modes = [r["body_language"] for r in frame_results]
-            agg_posture = max(set(posture_modes), key=posture_modes.count)
-            agg_bodylang = max(set(body_modes), key=body_modes.count)
-        else:
-            return {"error": "No persons detected in any frames."}
-
-        output = {
-            "frames_analyzed": len(frame_results),
-            "frame_results": frame_results,
-            "aggregated_posture_bodylang": {
-                "posture": agg_posture,
-                "body_language": agg_bodylang
-            }
-        }
+        async with received_file(file, path) as video_path:
+            if os.path.getsize(video_path) == 0:
+                raise ValueError(f"Uploaded video file is empty: {video_path}")
 
-        return output
+            return await analyze_source(("video", video_path))
 
     except Exception as e:
         return {"error": str(e)}
 
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+@app.post("/analyze_frames/")
+async def analyze_frame_batch(file: UploadFile = File(None), path: str = Form(None)):
+    """Same as /analyze/, but for frames the orchestrator already decoded and sampled."""
+    try:
+        async with received_file(file, path, ".frames") as batch_path:
+            return await analyze_source(("frames", batch_path))
+    except Exception as e:
+        return {"error": str(e)}
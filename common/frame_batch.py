@@ -0,0 +1,71 @@
+"""Compact on-disk/on-the-wire format for a batch of sampled frames.
+
+A batch file is just a run of records, one per frame:
+    frame index (int64, little endian) | payload length (uint32) | JPEG bytes
+so it can be written while decoding and read back one frame at a time, keeping
+memory flat no matter how many frames are in the batch.
+"""
+import struct
+
+import cv2
+import numpy as np
+
+RECORD_HEADER = struct.Struct("<qI")
+JPEG_QUALITY = 90
+
+
+def encode_frame(frame, quality=JPEG_QUALITY):
+    ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Failed to JPEG-encode frame")
+    return buf.tobytes()
+
+
+class FrameBatchWriter:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._f = open(path, "wb")
+
+    def write(self, frame_idx, payload):
+        """`payload` is an already encoded frame, so one encode can be shared by several batches."""
+        self._f.write(RECORD_HEADER.pack(frame_idx, len(payload)))
+        self._f.write(payload)
+        self.count += 1
+
+    def close(self):
+        self._f.close()
+
+
+def read_frame_batch(path, start=0, stop=None):
+    """Yields (frame_idx, BGR frame) pairs from a batch file, for the frames in [start, stop).
+    Frames outside the range are skipped without being decoded."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            frame_idx, length = RECORD_HEADER.unpack(header)
+            if stop is not None and frame_idx >= stop:
+                break
+            if frame_idx < start:
+                f.seek(length, 1)
+                continue
+            payload = f.read(length)
+            if len(payload) < length:
+                raise ValueError(f"Truncated frame batch: {path}")
+            frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+            yield frame_idx, frame
+
+
+def batch_length(path):
+    """Index of the last frame in a batch file plus one, read from the record headers only."""
+    last = -1
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            last, length = RECORD_HEADER.unpack(header)
+            f.seek(length, 1)
+    return last + 1
@@ -0,0 +1,104 @@
+import math
+import os
+
+import cv2
+
+DEFAULT_FPS = 30
+
+# Gaps of at least this many frames are skipped by seeking instead of grabbing frame by frame.
+# Seeking decodes forward from the previous keyframe, so it only pays off for gaps longer than
+# a typical GOP (~250 frames). 0 disables seeking.
+SEEK_GAP = int(os.getenv("FRAME_SEEK_GAP", "300"))
+
+
+def normalize_fps(fps):
+    """OpenCV reports 0 (or NaN) FPS for some containers, fall back to 30 like the services always did."""
+    if not fps or math.isnan(fps):
+        return DEFAULT_FPS
+    return fps
+
+
+class Schedule:
+    """Which frames an analyzer looks at: one frame every `seconds` of video (or every `frames`
+    frames), starting at `offset`."""
+
+    def __init__(self, seconds=None, frames=None, offset=0):
+        self.seconds = seconds
+        self.frames = frames
+        self.offset = offset
+
+    def __repr__(self):
+        return f"Schedule(seconds={self.seconds}, frames={self.frames}, offset={self.offset})"
+
+    def interval(self, fps):
+        if self.frames is not None:
+            return self.frames
+        return max(1, int(normalize_fps(fps) * self.seconds))
+
+    def wants(self, frame_idx, fps):
+        return frame_idx >= self.offset and (frame_idx - self.offset) % self.interval(fps) == 0
+
+    def next_index(self, frame_idx, fps):
+        """First frame at or after `frame_idx` this schedule wants."""
+        if frame_idx <= self.offset:
+            return self.offset
+        interval = self.interval(fps)
+        return self.offset + -(-(frame_idx - self.offset) // interval) * interval
+
+
+# Sampling rates of each analyzer, keyed the same way as the orchestrator's combined output.
+SCHEDULES = {
+    "crowd": Schedule(seconds=1),
+    "environment": Schedule(seconds=1),  # cheap scene-change probes, inference is gated on them
+    "emotion": Schedule(frames=5, offset=4),  # every 5th frame, counting from 1
+    "posture": Schedule(seconds=5),
+}
+
+
+class FrameSampler:
+    """Iterates (frame_idx, frame) over the frames of `cap` wanted by any of `schedules`.
+
+    Only wanted frames are decoded into images: frames in between are skipped with grab(),
+    which avoids the colour conversion and copy of retrieve(), and gaps of SEEK_GAP frames
+    or more are jumped over by seeking. `frames_read` holds how far into the video the
+    sampler got, which the emotion service reports as its frame count.
+
+    `start` and `stop` restrict it to the frames in [start, stop), for analyzing a video
+    in segments.
+    """
+
+    def __init__(self, cap, schedules, fps=None, seek_gap=SEEK_GAP, start=0, stop=None):
+        self.cap = cap
+        self.schedules = schedules if isinstance(schedules, (list, tuple)) else [schedules]
+        self.fps = normalize_fps(cap.get(cv2.CAP_PROP_FPS) if fps is None else fps)
+        self.seek_gap = seek_gap
+        self.start = start
+        self.stop = stop
+        self.frames_read = 0
+
+    def next_wanted(self, frame_idx):
+        return min(s.next_index(frame_idx, self.fps) for s in self.schedules)
+
+    def __iter__(self):
+        pos = 0  # index of the frame the capture returns next
+        # If seeking fails, the frames before start are grabbed through like any other gap
+        if self.start and self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start):
+            pos = self.frames_read = self.start
+        while True:
+            target = self.next_wanted(max(pos, self.start))
+            if self.stop is not None and target >= self.stop:
+                return
+            if self.seek_gap and target - pos >= self.seek_gap \
+                    and self.cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+                pos = target
+            while pos < target:
+                if not self.cap.grab():
+                    return
+                pos += 1
+                self.frames_read = pos
+            ret, frame = self.cap.read()
+            if not ret:
+                return
+            pos += 1
+            self.frames_read = pos
+            yield target, frame
@@ -0,0 +1,215 @@
+"""Small in-process metrics registry, served in the Prometheus text format.
+
+Every service creates its metrics here and mounts /metrics with `instrument(app, service)`,
+which also times each request and propagates the X-Request-ID header. Metrics recorded in
+segment worker processes (see segments.py) stay in those processes and are not reported.
+"""
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# Seconds, from fast per-batch stages up to whole analyses of long videos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_metrics = {}
+_lock = threading.Lock()
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_labels(self.label_names, key)} {_format_value(value)}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, n + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        counts, total, n = value
+        lines = [
+            f"{self.name}_bucket{_labels(self.label_names, key, [('le', _format_value(b))])} {c}"
+            for b, c in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_bucket{_labels(self.label_names, key, [('le', '+Inf')])} {n}")
+        lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_labels(self.label_names, key)} {n}")
+        return lines
+
+
+def _register(cls, name, *args, **kwargs):
+    """Metrics are created once per name, asking again returns the same one."""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, *args, **kwargs)
+        return _metrics[name]
+
+
+def counter(name, help, labels=()):
+    return _register(Counter, name, help, labels)
+
+
+def gauge(name, help, labels=()):
+    return _register(Gauge, name, help, labels)
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help, labels, buckets)
+
+
+def render():
+    with _lock:
+        metrics = list(_metrics.values())
+    return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+
+# Shared by every service, labelled with the service name
+STAGE_SECONDS = histogram("stage_seconds", "Time spent in each analysis stage", ("service", "stage"))
+FRAMES = counter("frames_total", "Sampled frames analyzed", ("service",))
+ITEMS = counter("items_total", "Faces, persons or zones analyzed", ("service", "item"))
+ANALYSIS_FPS = gauge("analysis_fps", "Sampled frames per second of the last analysis", ("service",))
+REQUEST_SECONDS = histogram("http_request_seconds", "Request latency", ("service", "method", "path", "status"))
+
+
+def stage(service, name):
+    """Context manager timing one stage, e.g. `with stage("crowd", "detection"): ...`"""
+    return STAGE_SECONDS.time(service=service, stage=name)
+
+
+def timed_frames(frames, service):
+    """Passes (frame_idx, frame) pairs through, timing how long each takes to produce (the
+    decode / read stage), counting them and setting the service's frames per second."""
+    iterator = iter(frames)
+    count = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            with stage(service, "decode"):
+                item = next(iterator, None)
+            if item is None:
+                return
+            count += 1
+            FRAMES.inc(service=service)
+            yield item
+    finally:
+        elapsed = time.perf_counter() - started
+        if count and elapsed > 0:
+            ANALYSIS_FPS.set(count / elapsed, service=service)
+
+
+def current_request_id():
+    return request_id_var.get()
+
+
+def set_request_id(request_id):
+    request_id_var.set(request_id)
+
+
+def request_headers():
+    """Headers for a call to another service, carrying the current request id."""
+    request_id = current_request_id()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def instrument(app, service):
+    """Adds /metrics to `app`, times every request, and takes the request id from the
+    X-Request-ID header (or makes a new one) for the length of the request, echoing it in
+    the response."""
+
+    @app.middleware("http")
+    async def track_request(request: Request, call_next):
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers[REQUEST_ID_HEADER] = request_id
+            return response
+        finally:
+            # Route templates (/jobs/{job_id}) rather than raw paths keep the label set small
+            route = request.scope.get("route")
+            path = getattr(route, "path", request.url.path)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, service=service,
+                                    method=request.method, path=path, status=status)
+            request_id_var.reset(token)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,101 @@
+"""Lazy model loading, warm-up and the /health and /ready probes.
+
+Services import their frameworks (torch, keras, ultralytics) and load their models in a
+`load` function instead of at import time. It runs in a background thread when the app starts,
+so the process is up (and answers /health) right away, and ends with a warm-up inference on a
+dummy input, so the first real request doesn't pay for graph building and allocations.
+/ready only returns 200 once that is done, so nothing is routed to a replica that is still
+loading.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from fastapi.responses import JSONResponse
+
+from common.metrics import stage, gauge
+
+# Set to 0 to skip the warm-up inference (e.g. when startup time matters more than the first request)
+WARMUP = os.getenv("MODEL_WARMUP", "1") != "0"
+
+MODELS_READY = gauge("models_ready", "1 once the service's models are loaded and warmed up", ("service",))
+
+
+class ModelLoader:
+    """Runs `load` and then `warm_up` once, from whichever comes first: the background thread
+    started with the app, a request, or a segment worker starting up."""
+
+    def __init__(self, service, load, warm_up=None):
+        self.service = service
+        self._load = load
+        self._warm_up = warm_up
+        self._lock = threading.Lock()
+        self.ready = False
+        self.error = None
+        self.load_seconds = None
+        MODELS_READY.set(0, service=service)
+
+    def ensure(self):
+        """Blocks until the models are loaded. A failed load raises here, and is retried by
+        the next call."""
+        if self.ready:
+            return
+        with self._lock:
+            if self.ready:
+                return
+            start = time.perf_counter()
+            try:
+                with stage(self.service, "model_load"):
+                    self._load()
+                if WARMUP and self._warm_up is not None:
+                    with stage(self.service, "warmup"):
+                        self._warm_up()
+            except Exception as e:
+                self.error = f"{type(e).__name__}: {e}"
+                raise RuntimeError(f"{self.service} models failed to load: {self.error}") from e
+            self.load_seconds = time.perf_counter() - start
+            self.error = None
+            self.ready = True
+            MODELS_READY.set(1, service=self.service)
+
+    async def wait(self):
+        """ensure() for async endpoints, the event loop keeps running while the models load."""
+        if not self.ready:
+            await asyncio.to_thread(self.ensure)
+
+    def start(self):
+        """Starts loading in the background."""
+        threading.Thread(target=self._load_quietly, name=f"{self.service}-models", daemon=True).start()
+
+    def _load_quietly(self):
+        try:
+            self.ensure()
+        except RuntimeError as e:
+            # Shows up in /ready, requests retry the load
+            print(e)
+
+    def status(self):
+        if self.ready:
+            return {"status": "ready", "service": self.service, "load_seconds": round(self.load_seconds, 3)}
+        if self.error is not None:
+            return {"status": "failed", "service": self.service, "error": self.error}
+        return {"status": "loading", "service": self.service}
+
+
+def add_probes(app, models):
+    """/health: the process is up. /ready: the models are loaded, 503 until then.
+    Loading starts with the app."""
+
+    @app.on_event("startup")
+    def load_models():
+        models.start()
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "service": models.service}
+
+    @app.get("/ready")
+    async def ready():
+        status = models.status()
+        return JSONResponse(status, status_code=200 if models.ready else 503)
@@ -0,0 +1,122 @@
+"""Time-segment parallel analysis.
+
+A video (or frame batch) is split into contiguous frame ranges that are analyzed at the same
+time by a pool of worker processes, then the per-segment outputs are merged by the service.
+Workers are spawned rather than forked (torch, keras and YOLO don't survive a fork), and
+import the service module and load its models when they start, so each one loads them once.
+"""
+import asyncio
+import importlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+from common.frames import FrameSampler, normalize_fps
+from common.frame_batch import read_frame_batch, batch_length
+
+# Sources shorter than this per worker are split into fewer segments (or not at all), as
+# starting a segment costs a seek and a cold model
+MIN_SEGMENT_SECONDS = float(os.getenv("MIN_SEGMENT_SECONDS", "60"))
+
+
+def source_info(source):
+    """(fps, frame count) of a ("video", path) or ("frames", path) source. A frame batch has
+    no fps of its own, so that is None."""
+    kind, path = source
+    if kind == "frames":
+        return None, batch_length(path)
+    cap = cv2.VideoCapture(path)
+    try:
+        return normalize_fps(cap.get(cv2.CAP_PROP_FPS)), int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+
+
+def iter_source(source, schedule, start=0, stop=None):
+    """(frame_idx, frame) pairs with start <= frame_idx < stop: decoded from a video using
+    `schedule`, or read from a frame batch (already sampled)."""
+    kind, path = source
+    if kind == "frames":
+        yield from read_frame_batch(path, start, stop)
+        return
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video file: {path}")
+    try:
+        yield from FrameSampler(cap, schedule, start=start, stop=stop)
+    finally:
+        cap.release()
+
+
+def split_range(length, n, align=1):
+    """Splits frames [0, length) into at most n (start, stop) segments whose starts are
+    multiples of `align`. The last segment is open ended (stop None), so frames past an
+    inaccurate frame count are still analyzed."""
+    size = -(-max(length, 1) // n)
+    size = -(-size // align) * align
+    segments = [(start, start + size) for start in range(0, max(length, 1), size)]
+    segments[-1] = (segments[-1][0], None)
+    return segments
+
+
+def _init_worker(env, module):
+    os.environ.update(env)
+    module = importlib.import_module(module)
+    # Services load their models lazily (see common/readiness.py)
+    if hasattr(module, "models"):
+        module.models.ensure()
+
+
+def _ready():
+    return True
+
+
+class SegmentPool:
+    """Process pool running the segments of service `module`. `env` is applied in each worker
+    before the module is imported, e.g. to give every worker a single thread."""
+
+    def __init__(self, workers, module, env=None):
+        self.workers = workers
+        self.module = module
+        self.env = env or {}
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return self.workers > 1
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.env, self.module),
+            )
+        return self._executor
+
+    def start(self):
+        """Starts every worker (and so loads the models) ahead of the first request."""
+        if self.enabled:
+            for _ in range(self.workers):
+                self.executor().submit(_ready)
+
+    def segments(self, length, fps, align=1):
+        """Segments for a source of `length` frames, a single one when it is too short to be
+        worth splitting."""
+        n = min(self.workers, int(length // (normalize_fps(fps) * MIN_SEGMENT_SECONDS)))
+        return split_range(length, max(n, 1), align)
+
+    async def run(self, fn, args_list):
+        """Runs fn(*args) for every args tuple in the pool, returns the results in order."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[
+            loop.run_in_executor(self.executor(), fn, *args) for args in args_list
+        ])
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
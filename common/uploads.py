@@ -0,0 +1,52 @@
+import os
+import tempfile
+from contextlib import asynccontextmanager
+
+CHUNK_SIZE = 1024 * 1024
+
+# Directory shared with the orchestrator (same host or volume). Inputs under it can be passed
+# by path instead of being uploaded again, see received_file.
+SHARED_UPLOAD_DIR = os.getenv("SHARED_UPLOAD_DIR")
+
+
+async def save_upload(file, suffix=None, directory=None, hasher=None, prefix=None):
+    """Streams an UploadFile into a temp file in 1MB chunks and returns its path, which is
+    unique even for uploads with the same name. `hasher` (e.g. hashlib.sha256()) is fed every
+    chunk on the way."""
+    suffix = suffix or os.path.splitext(file.filename or "")[-1] or ".mp4"
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, prefix=prefix, dir=directory) as tmp:
+        while True:
+            chunk = await file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if hasher is not None:
+                hasher.update(chunk)
+            tmp.write(chunk)
+        return tmp.name
+
+
+def shared_path(path):
+    """Checks that a path sent by the orchestrator is an existing file inside SHARED_UPLOAD_DIR."""
+    if not SHARED_UPLOAD_DIR:
+        raise ValueError("Path handoff is disabled, SHARED_UPLOAD_DIR is not set")
+    root = os.path.realpath(SHARED_UPLOAD_DIR)
+    real = os.path.realpath(path)
+    if os.path.commonpath([root, real]) != root or not os.path.isfile(real):
+        raise ValueError(f"Not a file in the shared upload directory: {path}")
+    return real
+
+
+@asynccontextmanager
+async def received_file(file, path=None, suffix=None):
+    """Local path of a request's input: either the shared file the orchestrator pointed at
+    (left in place), or the upload streamed to a temp file (removed afterwards)."""
+    if path:
+        yield shared_path(path)
+        return
+    if file is None:
+        raise ValueError("Either a file or a path is required")
+    tmp_path = await save_upload(file, suffix)
+    try:
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
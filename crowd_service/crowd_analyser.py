@@ -2,155 +2,346 @@ import cv2
 import json
 import joblib
 import numpy as np
-import tempfile
 import os
-from collections import deque, Counter
-from ultralytics import YOLO
+import sys
+import queue
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.cluster import DBSCAN
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.frames import FrameSampler, Schedule, SCHEDULES
+from common.frame_batch import read_frame_batch
+from common.uploads import save_upload, received_file
+from common.segments import SegmentPool, source_info, iter_source
+from common.metrics import instrument, stage, timed_frames, ITEMS
+from common.readiness import ModelLoader, add_probes
+
+# Sampled frames sent through YOLO in one call
+BATCH_SIZE = int(os.getenv("CROWD_BATCH_SIZE", "8"))
+# Zone grid as rows x cols, e.g. "8x8"
+GRID_SIZE = tuple(int(v) for v in os.getenv("CROWD_GRID", "4x4").lower().split("x"))
+CLUSTER_EPS = 40
+CLUSTER_MIN_SAMPLES = 2
+# Analyses running in parallel (each worker holds its own YOLO model) and the cap on
+# requests accepted at once, the rest wait for a slot
+WORKERS = int(os.getenv("CROWD_WORKERS", "2"))
+MAX_INFLIGHT = int(os.getenv("CROWD_MAX_INFLIGHT", "8"))
+# Camera streams whose zone history is kept between uploads
+MAX_STREAMS = int(os.getenv("CROWD_MAX_STREAMS", "64"))
+# Zone insights pushed to streaming clients the moment they happen
+ALERT_INSIGHTS = ("crowd surge detected", "panic onset")
+# Return every sampled frame's zone metrics too ("frame_details"), not only the window aggregates
+KEEP_FRAMES = os.getenv("CROWD_KEEP_FRAMES", "0") == "1"
+# Worker processes analyzing segments of one video in parallel (1 = off), each with its own
+# YOLO model. Only used for uploads without a stream_id.
+SEGMENTS = int(os.getenv("CROWD_SEGMENTS", "1"))
+
+
+# Model files live next to this file, so the analyser also loads in other processes (edge mode)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Per-frame zone metrics, in this order along the last axis of every metrics array
+METRICS = ("people", "density", "clusters")
+# Zone insights, stored as their index in this tuple
+INSIGHTS = ("initial observation", "crowd surge detected", "panic onset", "crowd calming",
+            "steady state", "minor variation")
+INITIAL, SURGE, PANIC, CALMING, STEADY, MINOR = range(len(INSIGHTS))
+# Sampled frames aggregated into one output window
+WINDOW = 10
+
+
+class CrowdSession:
+    """Zone history of one analysis or one camera stream, kept apart from the shared models
+    so concurrent uploads never see each other's history. Insights only compare a frame to
+    the one before, so that is all that is kept."""
+
+    def __init__(self, zones):
+        self.last_metrics = None  # (zones, metrics) of the previous frame
+        self.last_states = None   # (zones,) classifier class indices of the previous frame
+        self.lock = threading.Lock()
+
+
+class WindowStats:
+    """Running sums and label counts of the current window, for all zones at once, so a
+    window is aggregated without keeping its frames."""
+
+    def __init__(self, n_zones, n_states):
+        self.sums = np.zeros((n_zones, len(METRICS)))
+        self.state_counts = np.zeros((n_zones, n_states), dtype=int)
+        self.state_first = np.zeros((n_zones, n_states), dtype=int)
+        self.insight_counts = np.zeros((n_zones, len(INSIGHTS)), dtype=int)
+        self.insight_first = np.zeros((n_zones, len(INSIGHTS)), dtype=int)
+        self.zone_idx = np.arange(n_zones)
+        self.count = 0
+        self.first_frame = self.last_frame = None
+
+    def _count(self, counts, first, labels):
+        # Position of each label's first occurrence in the window, for breaking ties
+        new = counts[self.zone_idx, labels] == 0
+        first[self.zone_idx[new], labels[new]] = self.count
+        counts[self.zone_idx, labels] += 1
+
+    def add(self, frame_idx, metrics, states, insights):
+        self.sums += metrics
+        self._count(self.state_counts, self.state_first, states)
+        self._count(self.insight_counts, self.insight_first, insights)
+        if self.first_frame is None:
+            self.first_frame = frame_idx
+        self.last_frame = frame_idx
+        self.count += 1
+
+    def _dominant(self, counts, first):
+        # Same pick as Counter.most_common(1): the highest count, ties go to the label seen first
+        return np.argmax(counts * (self.count + 1) - first, axis=1)
+
+    def aggregate(self, zones, state_names):
+        means = self.sums / self.count
+        states = self._dominant(self.state_counts, self.state_first)
+        insights = self._dominant(self.insight_counts, self.insight_first)
+        return {
+            z: {
+                "avg_people": float(means[i, 0]),
+                "avg_density": float(means[i, 1]),
+                "avg_clusters": float(means[i, 2]),
+                "dominant_state": str(state_names[states[i]]),
+                "dominant_insight": INSIGHTS[insights[i]]
+            }
+            for i, z in enumerate(zones)
+        }
+
+
+class FrameStore:
+    """Per-frame detail of a whole analysis (only kept when asked for): arrays of
+    frames x zones (x metrics), states and insights stored as int codes. The arrays are
+    preallocated and double in size when full."""
+
+    def __init__(self, n_zones, capacity=256):
+        self.frames = np.zeros(capacity, dtype=np.int64)
+        self.metrics = np.zeros((capacity, n_zones, len(METRICS)), dtype=np.float32)
+        self.states = np.zeros((capacity, n_zones), dtype=np.int16)
+        self.confidences = np.zeros((capacity, n_zones), dtype=np.float32)
+        self.insights = np.zeros((capacity, n_zones), dtype=np.int8)
+        self.size = 0
+
+    def append(self, frame_idx, metrics, states, confidences, insights):
+        if self.size == len(self.frames):
+            for name in ("frames", "metrics", "states", "confidences", "insights"):
+                old = getattr(self, name)
+                grown = np.zeros((2 * len(old),) + old.shape[1:], dtype=old.dtype)
+                grown[:len(old)] = old
+                setattr(self, name, grown)
+        i = self.size
+        self.frames[i] = frame_idx
+        self.metrics[i] = metrics
+        self.states[i] = states
+        self.confidences[i] = confidences
+        self.insights[i] = insights
+        self.size += 1
+
+    def to_json(self, zones, state_names):
+        n = self.size
+        return {
+            "zones": zones,
+            "metrics": list(METRICS),
+            "state_names": [str(s) for s in state_names],
+            "insight_names": list(INSIGHTS),
+            "frames": self.frames[:n].tolist(),
+            "values": self.metrics[:n].tolist(),
+            "states": self.states[:n].tolist(),
+            "confidences": self.confidences[:n].tolist(),
+            "insights": self.insights[:n].tolist(),
+        }
+
 
 class CrowdAnalyser:
-    def __init__(self, grid_size=(4, 4), history=10):
-        self.model = YOLO("yolov8_mot20_best.pt")
+    def __init__(self, grid_size=GRID_SIZE, batch_size=BATCH_SIZE, classifier=None, keep_frames=KEEP_FRAMES):
+        from ultralytics import YOLO
+        self.model = YOLO(os.path.join(BASE_DIR, "yolov8_mot20_best.pt"))
         self.grid_size = grid_size
-        self.classifier = joblib.load("zone_rf.pkl")
-        self.history_len = history
-        self.history = {
-            f"{chr(65+i)}{j+1}": deque(maxlen=history)
-            for i in range(grid_size[0]) for j in range(grid_size[1])
-        }
+        self.batch_size = batch_size
+        # The zone classifier is read-only, so replicas can share one instance
+        self.classifier = classifier if classifier is not None else joblib.load(os.path.join(BASE_DIR, "zone_rf.pkl"))
+        self.keep_frames = keep_frames
+        # Zones are named row letter + column number (A1, A2, ...), in row-major order
+        self.zones = [f"{chr(65+i)}{j+1}" for i in range(grid_size[0]) for j in range(grid_size[1])]
+        classes = list(self.classifier.classes_)
+        self.calm = classes.index("calm") if "calm" in classes else -1
+        self.chaotic = classes.index("chaotic") if "chaotic" in classes else -1
+
+    def new_session(self):
+        return CrowdSession(self.zones)
 
-    def divide_frame(self, frame):
+    def detect_people(self, frames):
+        """Runs YOLO on a list of frames in one call, returns an (N, 4) array of person xyxy boxes per frame"""
+        results = self.model(frames, verbose=False)
+        return [r.boxes.xyxy[r.boxes.cls == 0].cpu().numpy() for r in results]
+
+    def iter_batches(self, frames):
+        """Groups (frame_idx, frame) pairs into lists of `batch_size`"""
+        batch = []
+        for item in frames:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def zone_metrics(self, frame, people=None):
+        """(zones, METRICS) array: people count, density and number of clusters of every zone."""
+        if people is None:
+            people = self.detect_people([frame])[0]
         h, w, _ = frame.shape
         gh, gw = self.grid_size
         sx, sy = w // gw, h // gh
-        zones = []
-        for i in range(gh):
-            for j in range(gw):
-                x1, y1, x2, y2 = j*sx, i*sy, (j+1)*sx, (i+1)*sy
-                zones.append(((x1, y1, x2, y2), f"{chr(65+i)}{j+1}"))
-        return zones
-
-    def extract_features(self, frame):
-        results = self.model(frame, verbose=False)
-        people = [box.xyxy[0].cpu().numpy() for box in results[0].boxes if int(box.cls[0]) == 0]
-        zones = self.divide_frame(frame)
-        feats = {}
-        for (x1, y1, x2, y2), name in zones:
-            zp = [p for p in people if x1 <= (p[0]+p[2])/2 <= x2 and y1 <= (p[1]+p[3])/2 <= y2]
-            n = len(zp)
-            d = n / ((x2-x1)*(y2-y1))
-            centroids = [((p[0]+p[2])/2, (p[1]+p[3])/2) for p in zp]
-            c = 0
-            if centroids:
-                clustering = DBSCAN(eps=40, min_samples=2).fit(np.array(centroids))
-                c = len(set(clustering.labels_)) - (1 if -1 in clustering.labels_ else 0)
-            feats[name] = [n, d, c]
-        return feats
-
-    def classify_zones(self, features):
-        json_out = {"zones": {}}
-        for z, fs in features.items():
-            pred = self.classifier.predict([fs])[0]
-            conf = max(self.classifier.predict_proba([fs])[0])
-            prev = self.history[z][-1] if len(self.history[z]) else None
-            insight = self.get_zone_insight(z, prev, fs, pred)
-            self.history[z].append({
-                "people": fs[0],
-                "density": fs[1],
-                "clusters": fs[2],
-                "state": pred,
-                "insight": insight
-            })
-            json_out["zones"][z] = {
-                "people": fs[0],
-                "density": fs[1],
-                "clusters": fs[2],
-                "state": pred,
-                "confidence": float(conf),
-                "insight": insight
-            }
-        return json_out
-
-    def get_zone_insight(self, zone, prev, fs, pred):
-        if not prev:
-            return "initial observation"
-        delta_people = fs[0] - prev["people"]
-        delta_density = fs[1] - prev["density"]
-        if delta_people > 3 or delta_density > 0.001:
-            return "crowd surge detected"
-        elif prev["state"] == "calm" and pred == "chaotic":
-            return "panic onset"
-        elif prev["state"] == "chaotic" and pred == "calm":
-            return "crowd calming"
-        elif abs(delta_people) < 1 and abs(delta_density) < 0.0001:
-            return "steady state"
-        else:
-            return "minor variation"
-
-    def aggregate_results(self, frames):
-        agg = {}
-        all_zones = frames[-1]["zones"].keys()
-        for z in all_zones:
-            people_vals = [f["zones"][z]["people"] for f in frames]
-            density_vals = [f["zones"][z]["density"] for f in frames]
-            cluster_vals = [f["zones"][z]["clusters"] for f in frames]
-            states = [f["zones"][z]["state"] for f in frames]
-            insights = [f["zones"][z]["insight"] for f in frames]
-
-            agg[z] = {
-                "avg_people": np.mean(people_vals),
-                "avg_density": np.mean(density_vals),
-                "avg_clusters": np.mean(cluster_vals),
-                "dominant_state": Counter(states).most_common(1)[0][0],
-                "dominant_insight": Counter(insights).most_common(1)[0][0]
-            }
-        return agg
 
-    def analyse_video(self, video_path):
+        # Bin every person's centroid into its zone in one pass. People in the leftover
+        # strip when the frame size is not divisible by the grid are not in any zone.
+        cx = (people[:, 0] + people[:, 2]) / 2
+        cy = (people[:, 1] + people[:, 3]) / 2
+        inside = (cx >= 0) & (cx <= gw*sx) & (cy >= 0) & (cy <= gh*sy)
+        cx, cy = cx[inside], cy[inside]
+        cols = np.minimum((cx // sx).astype(int), gw - 1)
+        rows = np.minimum((cy // sy).astype(int), gh - 1)
+        zone_idx = rows * gw + cols
+
+        counts = np.bincount(zone_idx, minlength=gh*gw)
+        clusters = self.count_clusters(cx, cy, zone_idx, w)
+        return np.column_stack([counts, counts / (sx * sy), clusters]).astype(float)
+
+    def extract_features(self, frame, people=None):
+        """zone -> [people, density, clusters]"""
+        return {
+            name: [int(m[0]), float(m[1]), int(m[2])]
+            for name, m in zip(self.zones, self.zone_metrics(frame, people))
+        }
+
+    def count_clusters(self, cx, cy, zone_idx, width):
+        """Number of DBSCAN clusters in each zone, from a single fit per frame. Each zone's
+        centroids are shifted apart along x so that no cluster can span two zones."""
+        n_zones = len(self.zones)
+        if len(zone_idx) < CLUSTER_MIN_SAMPLES:
+            return np.zeros(n_zones, dtype=int)
+        shifted = np.column_stack([cx + zone_idx * (width + 2*CLUSTER_EPS), cy])
+        labels = DBSCAN(eps=CLUSTER_EPS, min_samples=CLUSTER_MIN_SAMPLES).fit(shifted).labels_
+        found, first_member = np.unique(labels, return_index=True)
+        cluster_zones = zone_idx[first_member[found >= 0]]
+        return np.bincount(cluster_zones, minlength=n_zones)
+
+    def predict_states(self, metrics):
+        """Classifies every zone of a (frames, zones, METRICS) array with a single predict_proba
+        call. Returns (frames, zones) arrays of class indices and their confidences."""
+        frames, zones, _ = metrics.shape
+        proba = self.classifier.predict_proba(metrics.reshape(frames * zones, -1))
+        best = proba.argmax(axis=1)
+        confs = proba[np.arange(len(best)), best]
+        return best.reshape(frames, zones), confs.reshape(frames, zones)
+
+    def zone_insights(self, session, metrics, states):
+        """Insight code of every zone, comparing the frame to the session's previous one, and
+        makes this frame the previous one."""
+        prev, prev_states = session.last_metrics, session.last_states
+        session.last_metrics, session.last_states = metrics, states
+        if prev is None:
+            return np.full(len(states), INITIAL, dtype=np.int8)
+        delta_people = metrics[:, 0] - prev[:, 0]
+        delta_density = metrics[:, 1] - prev[:, 1]
+        return np.select(
+            [
+                (delta_people > 3) | (delta_density > 0.001),
+                (prev_states == self.calm) & (states == self.chaotic),
+                (prev_states == self.chaotic) & (states == self.calm),
+                (np.abs(delta_people) < 1) & (np.abs(delta_density) < 0.0001),
+            ],
+            [SURGE, PANIC, CALMING, STEADY],
+            default=MINOR,
+        ).astype(np.int8)
+
+    def analyse_video(self, video_path, session=None):
         """Main function to analyze a full video and return JSON results"""
+        return self.collect(self.iter_video(video_path, session))
+
+    def analyse_frames(self, frames, session=None, start=0, first_frame=None):
+        """Analyzes already sampled (frame_idx, frame) pairs, from a video or a frame batch"""
+        return self.collect(self.iter_analysis(frames, session, start, first_frame))
+
+    def collect(self, events):
+        result = {"aggregated_outputs": []}
+        for e in events:
+            if e["type"] == "window":
+                result["aggregated_outputs"].append({"frame_window": e["frame_window"], "aggregate": e["aggregate"]})
+            elif e["type"] == "frames":
+                result["frame_details"] = e["frame_details"]
+        return result
+
+    def iter_video(self, video_path, session=None):
         cap = cv2.VideoCapture(video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS) or 30
-        frame_interval = int(fps)
-        frame_idx = 0
-        processed_frames = []
-        aggregated_outputs = []
-
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if frame_idx % frame_interval == 0:
-                feats = self.extract_features(frame)
-                zones_json = self.classify_zones(feats)
-                processed_frames.append({"frame": frame_idx, "zones": zones_json["zones"]})
-
-                if len(processed_frames) % 10 == 0:
-                    agg = self.aggregate_results(processed_frames[-10:])
-                    aggregated_outputs.append({
-                        "frame_window": [processed_frames[-10]["frame"], frame_idx],
-                        "aggregate": agg,
-                    })
-                    print(f"Aggregated output for frames {processed_frames[-10]['frame']}–{frame_idx}")
-            frame_idx += 1
-
-        cap.release()
+        try:
+            yield from self.iter_analysis(FrameSampler(cap, SCHEDULES["crowd"]), session)
+        finally:
+            cap.release()
+
+    def iter_analysis(self, frames, session=None, start=0, first_frame=None):
+        """Yields events as soon as they are computed: an "insight" event whenever a zone hits one
+        of ALERT_INSIGHTS and a "window" event with the aggregate of every WINDOW sampled frames.
+        Windows are aggregated from running sums, so memory stays flat however long the video
+        is. With keep_frames, a last "frames" event holds every frame's zone metrics.
+        Without a session the analysis starts from an empty zone history. Frames before `start`
+        only fill the zone history (a segment warming up on the end of the previous one), and
+        `first_frame` overrides where the last, partial window is said to start."""
+        session = session or self.new_session()
+        state_names = self.classifier.classes_
+        stats = WindowStats(len(self.zones), len(state_names))
+        store = FrameStore(len(self.zones)) if self.keep_frames else None
+        alerts = [INSIGHTS.index(i) for i in ALERT_INSIGHTS]
+
+        for batch in self.iter_batches(timed_frames(frames, "crowd")):
+            with stage("crowd", "detection"):
+                people = self.detect_people([frame for _, frame in batch])
+            ITEMS.inc(sum(len(p) for p in people), service="crowd", item="persons")
+            with stage("crowd", "features"):
+                metrics = np.stack([self.zone_metrics(frame, p) for (_, frame), p in zip(batch, people)])
+            with stage("crowd", "classification"):
+                states, confs = self.predict_states(metrics)
+
+            for (frame_idx, _), frame_metrics, frame_states, frame_confs in zip(batch, metrics, states, confs):
+                insights = self.zone_insights(session, frame_metrics, frame_states)
+                if frame_idx < start:
+                    continue
+                stats.add(frame_idx, frame_metrics, frame_states, insights)
+                if store is not None:
+                    store.append(frame_idx, frame_metrics, frame_states, frame_confs, insights)
+                if first_frame is None:
+                    first_frame = frame_idx
+
+                for z in np.flatnonzero(np.isin(insights, alerts)):
+                    yield {"type": "insight", "frame": frame_idx, "zone": self.zones[z], "insight": INSIGHTS[insights[z]]}
+
+                if stats.count == WINDOW:
+                    with stage("crowd", "aggregation"):
+                        agg = stats.aggregate(self.zones, state_names)
+                    yield {"type": "window", "frame_window": [stats.first_frame, frame_idx], "aggregate": agg}
+                    stats = WindowStats(len(self.zones), len(state_names))
 
         # Handle short videos (<10s)
-        if len(processed_frames) > 0 and len(processed_frames) % 10 != 0:
-            agg = self.aggregate_results(processed_frames[-(len(processed_frames) % 10):])
-            aggregated_outputs.append({
-                "frame_window": [processed_frames[0]["frame"], processed_frames[-1]["frame"]],
-                "aggregate": agg,
-            })
-            print(f"Final aggregated output for frames {processed_frames[0]['frame']}–{processed_frames[-1]['frame']}")
+        if stats.count:
+            with stage("crowd", "aggregation"):
+                agg = stats.aggregate(self.zones, state_names)
+            yield {"type": "window", "frame_window": [first_frame, stats.last_frame], "aggregate": agg}
 
-        return {"aggregated_outputs": aggregated_outputs}
+        if store is not None:
+            yield {"type": "frames", "frame_details": store.to_json(self.zones, state_names)}
 
 
 
 app = FastAPI(title="Crowd Analysis API")
+instrument(app, "crowd")
 
 app.add_middleware(
     CORSMiddleware,
@@ -160,19 +351,203 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-analyzer = CrowdAnalyser()
+# One analyzer (YOLO model) per worker thread, checked out for the length of an analysis.
+# Filled by load_models, ultralytics (and torch) is only imported then.
+analyzers = queue.Queue()
+executor = ThreadPoolExecutor(max_workers=WORKERS)
+inflight = asyncio.Semaphore(MAX_INFLIGHT)
+
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
 
-@app.post("/analyze/")
-async def analyze(file: UploadFile):
-    """Handles video upload and returns crowd analysis results."""
-    suffix = os.path.splitext(file.filename)[-1] or ".mp4"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        contents = await file.read()
-        tmp.write(contents)
-        tmp_path = tmp.name
 
+def load_models():
+    first = CrowdAnalyser()
+    replicas = [first] + [CrowdAnalyser(classifier=first.classifier) for _ in range(WORKERS - 1)]
+    for analyzer in replicas:
+        analyzers.put(analyzer)
+
+
+def warm_up():
+    # Every replica sets up its own YOLO predictor on its first call
+    frame = np.zeros((640, 640, 3), dtype=np.uint8)
+    replicas = [analyzers.get() for _ in range(WORKERS)]
     try:
-        result = analyzer.analyse_video(tmp_path)
-        return result
+        for analyzer in replicas:
+            analyzer.detect_people([frame])
     finally:
-        os.remove(tmp_path)
\ No newline at end of file
+        for analyzer in replicas:
+            analyzers.put(analyzer)
+
+
+models = ModelLoader("crowd", load_models, warm_up)
+add_probes(app, models)
+
+
+def get_session(analyzer, stream_id):
+    """A fresh session per request, or the long-lived one of a camera stream (least recently
+    used streams are dropped past MAX_STREAMS)."""
+    if stream_id is None:
+        return analyzer.new_session()
+    with sessions_lock:
+        session = sessions.pop(stream_id, None) or analyzer.new_session()
+        sessions[stream_id] = session
+        while len(sessions) > MAX_STREAMS:
+            sessions.popitem(last=False)
+    return session
+
+
+def _with_analyzer(stream_id, fn):
+    analyzer = analyzers.get()
+    try:
+        session = get_session(analyzer, stream_id)
+        # Uploads of the same stream are analysed one after the other
+        with session.lock:
+            return fn(analyzer, session)
+    finally:
+        analyzers.put(analyzer)
+
+
+def analyse_frames(frames, stream_id=None):
+    """Analyses (frame_idx, frame) pairs on the calling thread, with an analyser from the pool.
+    For running the analysis in-process (orchestrator edge mode)."""
+    return _with_analyzer(stream_id, lambda a, s: a.analyse_frames(frames, s))
+
+
+async def run_analysis(method, source, stream_id=None):
+    """Runs an analysis on the worker pool without blocking the event loop."""
+    await models.wait()
+    async with inflight:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, _with_analyzer, stream_id, lambda a, s: getattr(a, method)(source, s)
+        )
+
+
+def analyse_segment(source, fps, start, stop, schedule=SCHEDULES["crowd"]):
+    """Runs in a segment worker process. The sampled frame just before `start` is analysed
+    first, so insights at the start of the segment compare against it like they would in
+    one piece."""
+    warmup = max(0, start - schedule.interval(fps))
+    frames = iter_source(source, schedule, warmup, stop)
+    # A partial last window is labelled from the first frame of the video, as in one piece
+    first_frame = schedule.next_index(0, fps)
+    return _with_analyzer(None, lambda a, s: a.analyse_frames(frames, s, start, first_frame))
+
+
+segment_pool = SegmentPool(SEGMENTS, __name__, {"CROWD_SEGMENTS": "1", "CROWD_WORKERS": "1", "OMP_NUM_THREADS": "1"})
+
+
+async def analyse_source(source, fps=None, schedule=SCHEDULES["crowd"]):
+    """Analyzes a video or frame batch without a stream history, in parallel segments when
+    enabled and long enough. Segments start on window boundaries (every 10 sampled frames),
+    so the windows are the same as in one piece and the outputs just get concatenated.
+    `schedule` is the sampling a frame batch was built with."""
+    video_fps, length = source_info(source)
+    fps = fps or video_fps
+    segments = [(0, None)]
+    if segment_pool.enabled:
+        segments = segment_pool.segments(length, fps, align=10 * schedule.interval(fps))
+    if len(segments) == 1:
+        return await run_analysis("analyse_frames", iter_source(source, schedule))
+    async with inflight:
+        parts = await segment_pool.run(analyse_segment,
+                                       [(source, fps, start, stop, schedule) for start, stop in segments])
+    merged = {"aggregated_outputs": [w for part in parts for w in part["aggregated_outputs"]]}
+    if "frame_details" in parts[0]:
+        details = [part["frame_details"] for part in parts]
+        merged["frame_details"] = {
+            **details[0],
+            **{k: [v for d in details for v in d[k]] for k in ("frames", "values", "states", "confidences", "insights")},
+        }
+    return merged
+
+
+@app.on_event("startup")
+def startup():
+    segment_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    segment_pool.shutdown()
+
+
+async def stream_analysis(video_path, stream_id=None):
+    """Runs iter_video on the worker pool and yields its events as NDJSON lines as they arrive."""
+    try:
+        await models.wait()
+    except RuntimeError as e:
+        yield json.dumps({"type": "error", "error": str(e)}) + "\n"
+        return
+    async with inflight:
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce(analyzer, session):
+            try:
+                for event in analyzer.iter_video(video_path, session):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, {"type": "error", "error": str(e)})
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, done)
+
+        future = loop.run_in_executor(executor, _with_analyzer, stream_id, produce)
+        try:
+            while (event := await events.get()) is not done:
+                yield json.dumps(event) + "\n"
+        finally:
+            # The client may have gone away, let the worker stop at the next event
+            stop.set()
+            await future
+
+
+@app.post("/analyze/")
+async def analyze(file: UploadFile = File(None), stream_id: str = Form(None), path: str = Form(None)):
+    """Handles video upload and returns crowd analysis results. Uploads sharing a `stream_id`
+    continue the same zone history. Instead of a file, `path` can point at a video in
+    SHARED_UPLOAD_DIR."""
+    try:
+        async with received_file(file, path) as video_path:
+            if stream_id is None and segment_pool.enabled:
+                return await analyse_source(("video", video_path))
+            return await run_analysis("analyse_video", video_path, stream_id)
+    except (ValueError, RuntimeError) as e:
+        return {"error": str(e)}
+
+
+@app.post("/analyze_frames/")
+async def analyze_frame_batch(file: UploadFile = File(None), stream_id: str = Form(None), path: str = Form(None),
+                              fps: float = Form(None), sample_interval: int = Form(None), sample_offset: int = Form(0)):
+    """Same as /analyze/, but for a batch of frames the orchestrator already decoded and sampled.
+    `fps` (of the source video) is needed to split the batch into segments, and
+    `sample_interval` / `sample_offset` (in frames) when it wasn't sampled at the default rate."""
+    schedule = SCHEDULES["crowd"] if sample_interval is None else Schedule(frames=sample_interval, offset=sample_offset)
+    try:
+        async with received_file(file, path, ".frames") as batch_path:
+            if stream_id is None and segment_pool.enabled and fps:
+                return await analyse_source(("frames", batch_path), fps, schedule)
+            return await run_analysis("analyse_frames", read_frame_batch(batch_path), stream_id)
+    except (ValueError, RuntimeError) as e:
+        return {"error": str(e)}
+
+
+@app.post("/analyze/stream/")
+async def analyze_stream(file: UploadFile, stream_id: str = Form(None)):
+    """Like /analyze/, but streams NDJSON events: window aggregates and crowd surge / panic onset
+    insights are sent as soon as they are computed instead of when the whole video is done."""
+    tmp_path = await save_upload(file)
+
+    async def body():
+        try:
+            async for line in stream_analysis(tmp_path, stream_id):
+                yield line
+        finally:
+            os.remove(tmp_path)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
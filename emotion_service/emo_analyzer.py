@@ -1,11 +1,18 @@
-from keras.models import load_model
 from collections import Counter
-from fastapi import FastAPI, UploadFile
+from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.middleware.cors import CORSMiddleware  
-import cv2, numpy as np, os, json, tempfile
+import cv2, numpy as np, os, sys, json, threading, asyncio
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.frames import FrameSampler, SCHEDULES
+from common.uploads import received_file
+from common.segments import SegmentPool, source_info, iter_source
+from common.metrics import instrument, stage, timed_frames, ITEMS
+from common.readiness import ModelLoader, add_probes
 
 
 app = FastAPI(title="Emotion Analysis API")
+instrument(app, "emotion")
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,62 +23,256 @@ app.add_middleware(
 )
 
 model_path = os.path.join(os.path.dirname(__file__), "emotion_model.keras")
-model  = load_model(model_path)
+model = None  # loaded by load_models, keras (and TensorFlow) is only imported then
 emotion_labels = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
+face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+# The cascade and the model are shared by all threads analyzing videos in-process (orchestrator
+# edge mode) and aren't safe to call at the same time
+cascade_lock = threading.Lock()
+model_lock = threading.Lock()
 
-@app.post("/analyze/")
-async def analyze_emotions(file: UploadFile):
-    temp_dir = tempfile.mkdtemp()
-    video_path = os.path.join(temp_dir, file.filename)
-    with open(video_path, "wb") as f:
-        f.write(await file.read())
-
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        return {"error": "Could not open uploaded video file"}
-
-    frame_skip = 5  # process every 5rd frame (NEED TO CHANGE)
-    frame_count = 0
-    all_emotions = []
-
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frame_count += 1
-        if frame_count % frame_skip != 0:
-            continue
-
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+# Face crops (from as many frames as it takes) sent through the model in one call
+BATCH_SIZE = int(os.getenv("EMOTION_BATCH_SIZE", "64"))
+# A face continues a track when its box overlaps the track's last box by at least this IoU
+TRACK_IOU = float(os.getenv("EMOTION_TRACK_IOU", "0.3"))
+# A tracked face is re-classified every N sampled frames, or sooner when its crop changes by
+# more than CROP_CHANGE (mean absolute pixel difference, 0-255). Otherwise its label is reused.
+RECLASSIFY_EVERY = int(os.getenv("EMOTION_RECLASSIFY_EVERY", "6"))
+CROP_CHANGE = float(os.getenv("EMOTION_CROP_CHANGE", "20"))
+# Tracks not seen for this many sampled frames are dropped
+TRACK_MAX_MISSES = 3
+# Worker processes analyzing segments of one video in parallel (1 = off), each with its own model
+SEGMENTS = int(os.getenv("EMOTION_SEGMENTS", "1"))
+
+
+def load_models():
+    global model
+    from keras.models import load_model
+    model = load_model(model_path)
+
+
+def warm_up():
+    model.predict_on_batch(np.zeros((1, 48, 48, 1), dtype=np.float32))
+
+
+models = ModelLoader("emotion", load_models, warm_up)
+add_probes(app, models)
+
+
+def detect_faces(frame):
+    """Returns (box, 48x48 grayscale crop) for every face in the frame."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    with cascade_lock:
         faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-        frame_emotions = []
+    return [((x, y, w, h), cv2.resize(gray[y:y+h, x:x+w], (48, 48))) for (x, y, w, h) in faces]
+
+
+def classify_faces(crops):
+    """Classifies a list of face crops with a single model call."""
+    face_input = np.stack(crops).astype(np.float32)[..., np.newaxis] / 255.0
+    with stage("emotion", "classification"), model_lock:
+        preds = model.predict_on_batch(face_input)
+    return [emotion_labels[int(i)] for i in np.argmax(preds, axis=1)]
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+class FaceTrack:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.misses = 0
+        self.slot = None  # index of this track's latest label in the label list
+        self.classified_crop = None
+        self.since_classified = 0
+
+    def needs_classification(self, crop):
+        if self.slot is None or self.since_classified >= RECLASSIFY_EVERY:
+            return True
+        diff = np.mean(np.abs(crop.astype(np.int16) - self.classified_crop.astype(np.int16)))
+        return diff > CROP_CHANGE
+
+
+class FaceTracker:
+    """Greedy IoU tracker: each face is matched to the free track it overlaps most."""
+
+    def __init__(self):
+        self.tracks = []
+        self.next_id = 0
+
+    def update(self, boxes):
+        """Returns the track of each box, starting new tracks for unmatched faces."""
+        pairs = sorted(
+            ((iou(t.box, b), ti, bi) for ti, t in enumerate(self.tracks) for bi, b in enumerate(boxes)),
+            reverse=True,
+        )
+        matched = [None] * len(boxes)
+        used = set()
+        for score, ti, bi in pairs:
+            if score < TRACK_IOU:
+                break
+            if ti in used or matched[bi] is not None:
+                continue
+            used.add(ti)
+            matched[bi] = self.tracks[ti]
+
+        for t in self.tracks:
+            t.misses = 0 if t in matched else t.misses + 1
+        self.tracks = [t for t in self.tracks if t.misses <= TRACK_MAX_MISSES]
+
+        for bi, box in enumerate(boxes):
+            if matched[bi] is None:
+                matched[bi] = FaceTrack(self.next_id, box)
+                self.next_id += 1
+                self.tracks.append(matched[bi])
+            matched[bi].box = box
+        return matched
+
+
+def build_timelines(observations, labels):
+    """Per track emotion timeline, consecutive sampled frames with the same label merged into one entry."""
+    timelines = {}
+    for track_id, frame_idx, slot in observations:
+        timeline = timelines.setdefault(str(track_id), [])
+        emotion = labels[slot]
+        if timeline and timeline[-1]["emotion"] == emotion:
+            timeline[-1]["end_frame"] = frame_idx
+        else:
+            timeline.append({"start_frame": frame_idx, "end_frame": frame_idx, "emotion": emotion})
+    return timelines
 
-        for (x, y, w, h) in faces:
-            face_img = gray[y:y+h, x:x+w]
-            face_resized = cv2.resize(face_img, (48, 48))
-            face_normalized = face_resized / 255.0
-            face_input = np.expand_dims(face_normalized, axis=(0, -1))
-            pred = model.predict(face_input, verbose=0)
-            emotion_index = int(np.argmax(pred))
-            frame_emotions.append(emotion_labels[emotion_index])
 
-        all_emotions.extend(frame_emotions)
+def analyze_frames(frames):
+    """Tracks and classifies the faces in already sampled (frame_idx, frame) pairs.
+    Returns (emotion of every face seen, per track timelines, number of model classifications)."""
+    tracker = FaceTracker()
+    labels = []        # classified labels, filled in one batch at a time
+    pending = []       # crops waiting to be classified, they get slots len(labels), len(labels)+1, ...
+    observations = []  # (track id, frame_idx, label slot) for every face seen
 
-    cap.release()
+    for frame_idx, frame in timed_frames(frames, "emotion"):
+        with stage("emotion", "detection"):
+            faces = detect_faces(frame)
+        ITEMS.inc(len(faces), service="emotion", item="faces")
+        with stage("emotion", "tracking"):
+            tracks = tracker.update([box for box, _ in faces])
+        for track, (_, crop) in zip(tracks, faces):
+            track.since_classified += 1
+            if track.needs_classification(crop):
+                track.slot = len(labels) + len(pending)
+                track.classified_crop = crop
+                track.since_classified = 0
+                pending.append(crop)
+            observations.append((track.id, frame_idx, track.slot))
 
+        if len(pending) >= BATCH_SIZE:
+            labels.extend(classify_faces(pending))
+            pending = []
+
+    if pending:
+        labels.extend(classify_faces(pending))
+    all_emotions = [labels[slot] for _, _, slot in observations]
+    return all_emotions, build_timelines(observations, labels), len(labels)
+
+
+def summarize(analysis, frame_count):
+    all_emotions, timelines, classified = analysis
     if len(all_emotions) == 0:
-        result = {"message": "No faces detected in processed frames."}
-    else:
-        counts = Counter(all_emotions)
-        total = len(all_emotions)
-        percentages = {emo: round((count / total) * 100, 2) for emo, count in counts.items()}
-        result = {
-            "frames_analyzed": frame_count,
-            "total_faces_detected": total,
-            "emotion_distribution": percentages,
-            "dominant_emotion": max(percentages, key=percentages.get),
-        }
-
-    return result
\ No newline at end of file
+        return {"message": "No faces detected in processed frames."}
+    counts = Counter(all_emotions)
+    total = len(all_emotions)
+    percentages = {emo: round((count / total) * 100, 2) for emo, count in counts.items()}
+    return {
+        "frames_analyzed": frame_count,
+        "total_faces_detected": total,
+        "faces_classified": classified,
+        "emotion_distribution": percentages,
+        "dominant_emotion": max(percentages, key=percentages.get),
+        "tracks": timelines,
+    }
+
+
+def analyze_segment(source, start, stop):
+    """Runs in a segment worker process."""
+    return analyze_frames(iter_source(source, SCHEDULES["emotion"], start, stop))
+
+
+def merge_segments(parts):
+    """Combines per-segment analyze_frames outputs. Faces are tracked within a segment only,
+    so track ids are prefixed with the segment number."""
+    all_emotions, timelines, classified = [], {}, 0
+    for i, (emotions, segment_timelines, n) in enumerate(parts):
+        all_emotions.extend(emotions)
+        timelines.update({f"{i}-{track_id}": t for track_id, t in segment_timelines.items()})
+        classified += n
+    return all_emotions, timelines, classified
+
+
+segment_pool = SegmentPool(SEGMENTS, __name__, {"EMOTION_SEGMENTS": "1", "OMP_NUM_THREADS": "1"})
+
+
+async def analyze_segmented(source, length, fps):
+    segments = segment_pool.segments(length, fps)
+    parts = await segment_pool.run(analyze_segment, [(source, start, stop) for start, stop in segments])
+    return merge_segments(parts)
+
+
+@app.on_event("startup")
+def startup():
+    segment_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    segment_pool.shutdown()
+
+
+@app.post("/analyze/")
+async def analyze_emotions(file: UploadFile = File(None), path: str = Form(None)):
+    """Takes an uploaded video (streamed to disk), or the `path` of one in SHARED_UPLOAD_DIR."""
+    try:
+        await models.wait()
+        async with received_file(file, path) as video_path:
+            cap = cv2.VideoCapture(video_path)
+            if not cap.isOpened():
+                return {"error": "Could not open uploaded video file"}
+
+            fps, length = source_info(("video", video_path))
+            if segment_pool.enabled and len(segment_pool.segments(length, fps)) > 1:
+                cap.release()
+                return summarize(await analyze_segmented(("video", video_path), length, fps), length)
+
+            # process every 5th frame (NEED TO CHANGE), off the event loop so /ready and
+            # /metrics still answer during the analysis
+            sampler = FrameSampler(cap, SCHEDULES["emotion"])
+            analysis = await asyncio.to_thread(analyze_frames, sampler)
+
+            cap.release()
+    except (ValueError, RuntimeError) as e:
+        return {"error": str(e)}
+
+    return summarize(analysis, sampler.frames_read)
+
+
+@app.post("/analyze_frames/")
+async def analyze_frame_batch(file: UploadFile = File(None), frame_count: int = Form(...), path: str = Form(None),
+                              fps: float = Form(None)):
+    """Same as /analyze/, but for frames the orchestrator already decoded and sampled.
+    `frame_count` is the length of the source video."""
+    try:
+        await models.wait()
+        async with received_file(file, path, ".frames") as batch_path:
+            source = ("frames", batch_path)
+            if segment_pool.enabled:
+                return summarize(await analyze_segmented(source, frame_count, fps), frame_count)
+            analysis = await asyncio.to_thread(analyze_frames, iter_source(source, SCHEDULES["emotion"]))
+            return summarize(analysis, frame_count)
+    except (ValueError, RuntimeError) as e:
+        return {"error": str(e)}
@@ -0,0 +1,40 @@
+"""The environment model, kept apart from envir_analyzer so torch and torchvision are only
+imported when the model is loaded."""
+import torch
+from torch import nn
+from torchvision import models
+
+num_features = 512
+
+class MultiFeatureModel(nn.Module):
+    def __init__(self, backbone, features):
+        super().__init__()
+        self.backbone = backbone
+        self.backbone.fc = nn.Identity()
+        self.feature_heads = nn.ModuleDict({
+            feat: nn.Linear(num_features, len(classes)) for feat, classes in features.items()
+        })
+
+    def forward(self, x):
+        x = self.backbone(x)
+        out = {feat: head(x) for feat, head in self.feature_heads.items()}
+        return out
+
+
+def load_model(path, features):
+    model = MultiFeatureModel(models.resnet18(weights=None), features)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    model.eval()
+    return model
+
+
+def build_variant(float_model, variant, image_size):
+    # There is no quantized variant: dynamic quantization only covers the nn.Linear heads
+    # (4 x 512->k), a negligible share of ResNet18's compute, and static quantization of the
+    # backbone would need calibration frames from the cameras.
+    if variant == "traced":
+        example = torch.zeros(1, 3, image_size, image_size)
+        with torch.inference_mode():
+            traced = torch.jit.trace(float_model, example, strict=False)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    raise ValueError(f"Unknown ENV_MODEL_VARIANT: {variant}")
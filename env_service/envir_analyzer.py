@@ -1,17 +1,22 @@
 import os
 import json
-import torch
-from torch import nn
-from torchvision import models, transforms
-from fastapi import FastAPI, UploadFile
+import asyncio
+from fastapi import FastAPI, UploadFile, Form, File
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
 import cv2
 import numpy as np
 from collections import Counter
-import tempfile
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.frames import SCHEDULES, normalize_fps
+from common.uploads import received_file
+from common.segments import SegmentPool, source_info, iter_source
+from common.metrics import instrument, stage, timed_frames, ITEMS
+from common.readiness import ModelLoader, add_probes
 
 app = FastAPI(title="Environment Analysis API")
+instrument(app, "environment")
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,44 +33,85 @@ features = {
     "cleanliness": ["clean", "messy"]
 }
 
-num_features = 512
+# Sampled frames run through the model in one forward pass
+BATCH_SIZE = int(os.getenv("ENV_BATCH_SIZE", "16"))
+# "float" (the trained model as is) or "traced" (frozen TorchScript, conv+bn fused), which
+# test_env_model.py checks against the float model
+MODEL_VARIANT = os.getenv("ENV_MODEL_VARIANT", "float")
+
+# Scene-change gating: every sampled frame is compared to the last inferred one using
+# THUMB_SIZE x THUMB_SIZE grayscale thumbnails, a mean absolute difference above SCENE_CHANGE
+# (0-255) triggers inference
+THUMB_SIZE = 16
+SCENE_CHANGE = float(os.getenv("ENV_SCENE_CHANGE", "12"))
+MAX_REFRESH_SECONDS = float(os.getenv("ENV_MAX_REFRESH_SECONDS", "60"))
+REPORT_SECONDS = 10
+# Worker processes analyzing segments of one video in parallel (1 = off). Each worker
+# loads its own model and runs torch on one thread.
+SEGMENTS = int(os.getenv("ENV_SEGMENTS", "1"))
+
+IMAGE_SIZE = 224
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+model_path = os.path.join(os.path.dirname(__file__), "multi_feature_model.pth")
+model = None  # loaded by load_models, torch is only imported then
 
-class MultiFeatureModel(nn.Module):
-    def __init__(self, backbone, features):
-        super().__init__()
-        self.backbone = backbone
-        self.backbone.fc = nn.Identity()
-        self.feature_heads = nn.ModuleDict({
-            feat: nn.Linear(num_features, len(classes)) for feat, classes in features.items()
-        })
 
-    def forward(self, x):
-        x = self.backbone(x)
-        out = {feat: head(x) for feat, head in self.feature_heads.items()}
-        return out
+def load_models():
+    global model
+    import torch
+    from env_model import load_model, build_variant
+
+    # CPU threading: intra-op threads split a single batch, inter-op threads run independent ops
+    if os.getenv("ENV_TORCH_THREADS"):
+        torch.set_num_threads(int(os.getenv("ENV_TORCH_THREADS")))
+    if os.getenv("ENV_TORCH_INTEROP_THREADS"):
+        torch.set_num_interop_threads(int(os.getenv("ENV_TORCH_INTEROP_THREADS")))
+
+    model = load_model(model_path, features)
+    if MODEL_VARIANT != "float":
+        model = build_variant(model, MODEL_VARIANT, IMAGE_SIZE)
+
+
+def warm_up():
+    import torch
+    with torch.inference_mode():
+        model(torch.from_numpy(preprocess([np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)])))
 
-model = MultiFeatureModel(models.resnet18(weights=None), features)
-model_path = os.path.join(os.path.dirname(__file__), "multi_feature_model.pth")
-model.load_state_dict(torch.load(model_path, map_location="cpu"))
-model.eval()
 
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                         std=[0.229, 0.224, 0.225])
-])
+models = ModelLoader("environment", load_models, warm_up)
+add_probes(app, models)
 
 outputs_dir = os.path.join(os.path.dirname(__file__), "outputs")
 os.makedirs(outputs_dir, exist_ok=True)
 
+
+def preprocess(frames):
+    """BGR frames straight to a normalized NCHW float array. Approximately the old PIL
+    Resize -> ToTensor -> Normalize pipeline: INTER_AREA isn't PIL's antialiased bilinear, so
+    pixels at sharp edges differ, test_env_model.py checks the predictions still agree."""
+    batch = np.stack([
+        cv2.cvtColor(cv2.resize(f, (IMAGE_SIZE, IMAGE_SIZE), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        for f in frames
+    ]).astype(np.float32)
+    batch = (batch / 255.0 - MEAN) / STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+def analyze_batch(frames):
+    import torch
+    ITEMS.inc(len(frames), service="environment", item="inferred_frames")
+    with stage("environment", "preprocess"):
+        batch = torch.from_numpy(preprocess(frames))
+    with stage("environment", "inference"), torch.inference_mode():
+        outputs = model(batch)
+    idx = {feat: out.argmax(dim=1).tolist() for feat, out in outputs.items()}
+    return [{feat: features[feat][idx[feat][i]] for feat in features} for i in range(len(frames))]
+
+
 def analyze_frame(frame):
-    img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-    img_t = transform(img).unsqueeze(0)
-    with torch.no_grad():
-        outputs = model(img_t)
-        preds = {feat: features[feat][torch.argmax(out).item()] for feat, out in outputs.items()}
-    return preds
+    return analyze_batch([frame])[0]
 
 
 def aggregate_results(results):
@@ -77,57 +123,122 @@ def aggregate_results(results):
         agg[feat] = Counter(feat_values).most_common(1)[0][0]
     return agg
 
-@app.post("/analyze/")
-async def analyze(file: UploadFile):
-    suffix = os.path.splitext(file.filename)[-1] or ".mp4"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        while True:
-            chunk = await file.read(1024 * 1024)  
-            if not chunk:
-                break
-            tmp.write(chunk)
-        tmp.flush()  
-        tmp_path = tmp.name
 
-    try:
-        if not os.path.exists(tmp_path) or os.path.getsize(tmp_path) == 0:
-            raise ValueError(f"Uploaded video file is empty: {tmp_path}")
+def scene_thumbnail(frame):
+    """Tiny grayscale version of the frame, enough to notice lighting or scene changes."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def analyze_frames(frames, fps):
+    """Runs the model only on frames where the scene changed since the last inferred frame,
+    or when MAX_REFRESH_SECONDS passed without inference. In between the last prediction is
+    carried forward and recorded every REPORT_SECONDS, so the aggregate still weighs every
+    part of the video. Each entry of frame_results says whether it was inferred."""
+    report_every = max(1, int(normalize_fps(fps) * REPORT_SECONDS))
+    max_gap = max(1, int(normalize_fps(fps) * MAX_REFRESH_SECONDS))
+
+    labels = []   # predictions, filled in one batch at a time
+    pending = []  # frames waiting for inference, they get slots len(labels), len(labels)+1, ...
+    entries = []  # (frame_idx, prediction slot, inferred)
+    last_thumb = None
+    last_inferred = last_entry = None
+    slot = None
+
+    for frame_idx, frame in timed_frames(frames, "environment"):
+        thumb = scene_thumbnail(frame)
+        if last_thumb is None or frame_idx - last_inferred >= max_gap \
+                or np.mean(np.abs(thumb - last_thumb)) > SCENE_CHANGE:
+            slot = len(labels) + len(pending)
+            pending.append(frame)
+            last_thumb, last_inferred = thumb, frame_idx
+            entries.append((frame_idx, slot, True))
+            last_entry = frame_idx
+        elif frame_idx - last_entry >= report_every:
+            entries.append((frame_idx, slot, False))
+            last_entry = frame_idx
+
+        if len(pending) == BATCH_SIZE:
+            labels.extend(analyze_batch(pending))
+            pending = []
+    if pending:
+        labels.extend(analyze_batch(pending))
+
+    frame_results = [
+        {"frame": frame_idx, "inferred": inferred, **labels[slot]}
+        for frame_idx, slot, inferred in entries
+    ]
+    with stage("environment", "aggregation"):
+        agg = aggregate_results(frame_results)
+    return {
+        "frames_analyzed": len(frame_results),
+        "frames_inferred": len(labels),
+        "frame_results": frame_results,
+        "aggregated_environment": agg
+    }
 
-        cap = cv2.VideoCapture(tmp_path)
-        if not cap.isOpened():
-            raise ValueError(f"Failed to open video file: {tmp_path}")
+def analyze_segment(source, fps, start, stop):
+    """Runs in a segment worker process."""
+    return analyze_frames(iter_source(source, SCHEDULES["environment"], start, stop), fps)
 
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        if fps == 0 or np.isnan(fps):
-            fps = 30 
-        frame_interval = int(fps * 10)  
 
-        frame_idx = 0
-        frame_results = []
+def merge_segments(parts):
+    """Same output as analyze_frames over the whole video. Scene gating restarts at each
+    segment, so the first frame of every segment is inferred."""
+    frame_results = [r for part in parts for r in part["frame_results"]]
+    return {
+        "frames_analyzed": len(frame_results),
+        "frames_inferred": sum(part["frames_inferred"] for part in parts),
+        "frame_results": frame_results,
+        "aggregated_environment": aggregate_results(frame_results)
+    }
 
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if frame_idx % frame_interval == 0:
-                preds = analyze_frame(frame)
-                frame_results.append(preds)
-            frame_idx += 1
 
-        cap.release()
+segment_pool = SegmentPool(SEGMENTS, __name__, {"ENV_TORCH_THREADS": "1", "ENV_SEGMENTS": "1"})
+
+
+async def analyze_source(source, fps=None):
+    """Analyzes a video or frame batch, in parallel segments when enabled and long enough."""
+    await models.wait()
+    video_fps, length = source_info(source)
+    fps = fps or video_fps
+    segments = segment_pool.segments(length, fps) if segment_pool.enabled else [(0, None)]
+    if len(segments) == 1:
+        # Off the event loop, so /ready and /metrics still answer during the analysis
+        return await asyncio.to_thread(analyze_frames, iter_source(source, SCHEDULES["environment"]), fps)
+    parts = await segment_pool.run(analyze_segment, [(source, fps, start, stop) for start, stop in segments])
+    return merge_segments(parts)
 
-        agg = aggregate_results(frame_results)
-        output = {
-            "frames_analyzed": len(frame_results),
-            "frame_results": frame_results,
-            "aggregated_environment": agg
-        }
 
-        return output
+@app.on_event("startup")
+def startup():
+    segment_pool.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    segment_pool.shutdown()
+
+
+@app.post("/analyze/")
+async def analyze(file: UploadFile = File(None), path: str = Form(None)):
+    """Takes an uploaded video, or the `path` of one in SHARED_UPLOAD_DIR."""
+    try:
+        async with received_file(file, path) as video_path:
+            if os.path.getsize(video_path) == 0:
+                raise ValueError(f"Uploaded video file is empty: {video_path}")
+
+            return await analyze_source(("video", video_path))
 
     except Exception as e:
         return {"error": str(e)}
 
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+@app.post("/analyze_frames/")
+async def analyze_frame_batch(file: UploadFile = File(None), fps: float = Form(...), path: str = Form(None)):
+    """Same as /analyze/, but for frames the orchestrator already decoded and sampled."""
+    try:
+        async with received_file(file, path, ".frames") as batch_path:
+            return await analyze_source(("frames", batch_path), fps)
+    except Exception as e:
+        return {"error": str(e)}
@@ -0,0 +1,90 @@
+"""Checks the traced environment model, and the OpenCV preprocessing, against the float model
+with the original torchvision preprocessing on synthetic scene images. Uses
+multi_feature_model.pth when it is there, randomly initialised weights otherwise."""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import envir_analyzer
+from env_model import MultiFeatureModel, load_model, build_variant
+
+# Share of (image, feature) predictions the variant must pick the same class on
+MIN_AGREEMENT = 0.98
+# Same for the preprocessing, which only approximates the torchvision resize (1 of the 24
+# images may flip per feature)
+PREPROCESS_AGREEMENT = 0.95
+
+
+def scene_images(n=24, seed=0):
+    """Street or room like scenes: a sky / ceiling band over a ground / floor band, lit from
+    night to bright, with boxes standing in for people and clutter, plus sensor noise."""
+    rng = np.random.default_rng(seed)
+    h, w = 360, 640
+    images = []
+    for i in range(n):
+        light = (i % 6 + 1) / 6
+        horizon = int(rng.integers(h // 4, h // 2))
+        img = np.zeros((h, w, 3), dtype=np.float32)
+        img[:horizon] = rng.integers(80, 256, 3)
+        img[horizon:] = rng.integers(30, 160, 3)
+        img *= np.linspace(1.0, 0.6, h, dtype=np.float32)[:, None, None] * light
+        for _ in range(int(rng.integers(3, 12))):
+            x, y = int(rng.integers(0, w - 40)), int(rng.integers(horizon - 20, h - 40))
+            bw, bh = int(rng.integers(15, 80)), int(rng.integers(30, 140))
+            cv2.rectangle(img, (x, y), (x + bw, y + bh), rng.integers(0, 256, 3).tolist(), -1)
+        img += rng.normal(0, 6, img.shape)
+        images.append(np.clip(img, 0, 255).astype(np.uint8))
+    return images
+
+
+@pytest.fixture(scope="module")
+def float_model():
+    if os.path.exists(envir_analyzer.model_path):
+        return load_model(envir_analyzer.model_path, envir_analyzer.features)
+    from torchvision import models
+    torch.manual_seed(0)
+    return MultiFeatureModel(models.resnet18(weights=None), envir_analyzer.features).eval()
+
+
+def predict(model, images):
+    with torch.inference_mode():
+        return model(torch.from_numpy(envir_analyzer.preprocess(images)))
+
+
+def test_traced_matches_float(float_model):
+    images = scene_images()
+    expected = predict(float_model, images)
+    actual = predict(build_variant(float_model, "traced", envir_analyzer.IMAGE_SIZE), images)
+    for feat in envir_analyzer.features:
+        agreement = (expected[feat].argmax(dim=1) == actual[feat].argmax(dim=1)).float().mean().item()
+        assert agreement >= MIN_AGREEMENT, f"{feat}: {agreement:.1%} agreement"
+        torch.testing.assert_close(actual[feat], expected[feat], rtol=1e-3, atol=1e-3)
+
+
+def test_unknown_variant(float_model):
+    with pytest.raises(ValueError):
+        build_variant(float_model, "quantized", envir_analyzer.IMAGE_SIZE)
+
+
+def test_preprocess_matches_torchvision(float_model):
+    transforms = pytest.importorskip("torchvision.transforms")
+    from PIL import Image
+    transform = transforms.Compose([
+        transforms.Resize((envir_analyzer.IMAGE_SIZE, envir_analyzer.IMAGE_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    images = scene_images()
+    reference = torch.stack([transform(Image.fromarray(cv2.cvtColor(f, cv2.COLOR_BGR2RGB))) for f in images])
+    actual = torch.from_numpy(envir_analyzer.preprocess(images))
+    # Pixels differ at sharp edges only
+    assert (actual - reference).abs().mean().item() < 0.02
+    with torch.inference_mode():
+        expected, predicted = float_model(reference), float_model(actual)
+    for feat in envir_analyzer.features:
+        agreement = (expected[feat].argmax(dim=1) == predicted[feat].argmax(dim=1)).float().mean().item()
+        assert agreement >= PREPROCESS_AGREEMENT, f"{feat}: {agreement:.1%} agreement"
@@ -1,13 +1,52 @@
-from fastapi import FastAPI, UploadFile, Form
+from fastapi import FastAPI, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import requests, numpy as np, cv2, os, json, time
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+import httpx, asyncio, numpy as np, cv2, os, sys, json, time, shutil, tempfile, re, uuid, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from graph_utils import generate_graphs 
-from gemini_api import analyze_with_gemini  
+from frame_pipeline import extract_frame_batches
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.uploads import save_upload
+from common.metrics import instrument, stage, histogram, set_request_id, current_request_id, request_headers
+from common.segments import source_info
+from result_cache import ResultCache, hash_file, make_key
+from jobs import JobQueue, QueueFull
+from graph_utils import GRAPH_FILES, SERIES_FILE, save_series, load_series, render_graph
+from gemini_api import analyze_with_gemini_async
+from selection import load_policy, complete_plan, CostModel, fit_budget, rate_factor
 # from email_utils import send_email_alert 
 from fastapi.staticfiles import StaticFiles
 
 app = FastAPI()
+instrument(app, "orchestrator")
+
+SERVICE_SECONDS = histogram("service_call_seconds", "Analyzer service calls as seen by the orchestrator",
+                            ("target", "outcome"))
+
+# One long-lived client for every call to the analyzer services, so uploads reuse
+# keep-alive connections instead of opening a new socket per request.
+http_client = None
+
+
+@app.on_event("startup")
+async def startup():
+    global http_client
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("SERVICE_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("SERVICE_MAX_KEEPALIVE", "20")),
+        ),
+    )
+    if EDGE_MODE:
+        edge.start()
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await job_queue.stop()
+    await http_client.aclose()
+    graph_executor.shutdown(wait=False)
 
 # === Output folder setup ===
 outputs_path = os.path.join(os.path.dirname(__file__), "outputs")
@@ -15,6 +54,11 @@ os.makedirs(outputs_path, exist_ok=True)
 
 app.mount("/outputs", StaticFiles(directory=outputs_path), name="outputs")
 
+# Charts are drawn on their first GET, by a small pool of threads, never in the request
+# that analyzed the video
+graphs_path = os.path.join(outputs_path, "graphs")
+graph_executor = ThreadPoolExecutor(max_workers=int(os.getenv("GRAPH_WORKERS", "2")))
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -28,37 +72,262 @@ ENV_URL = "http://127.0.0.1:8200/analyze/"
 EMOTION_URL = "http://127.0.0.1:8300/analyze/"
 BODY_URL = "http://127.0.0.1:8400/analyze/"
 
+# When on, the orchestrator decodes the upload once and sends every service only the frames
+# it samples (see frame_pipeline.py) instead of the whole video.
+FRAME_PIPELINE = os.getenv("FRAME_PIPELINE", "1") == "1"
 
+# When on, the analyzers run inside this process on a single decoded frame stream (see edge.py)
+# and the services above aren't used. For small boxes in front of a few cameras.
+EDGE_MODE = os.getenv("EDGE_MODE", "0") == "1"
+if EDGE_MODE:
+    import edge
 
-@app.post("/process/")
-async def process(file: UploadFile, context: str = Form(...)):
-    contents = await file.read()
-    input_path = f"uploads/{int(time.time())}_{file.filename}"
-    os.makedirs("uploads", exist_ok=True)
-    with open(input_path, "wb") as f:
-        f.write(contents)
-
-    # This part will be replaced by something that hopefully maybe uses parallel processing (cuz currently its serial), and
-    # adding RL choose which services to call based on context!
-    with open(input_path, "rb") as f:
-        files = {"file": (file.filename, f, file.content_type)}
-        try:
-            crowd_resp = requests.post(CROWD_URL, files=files, timeout=300).json()
-            f.seek(0)
-            environment_resp = requests.post(ENV_URL, files=files, timeout=300).json()
-            f.seek(0)
-            emotion_resp = requests.post(EMOTION_URL, files=files, timeout=300).json()
-            f.seek(0)
-            posture_resp = requests.post(BODY_URL, files=files, timeout=300).json()
+# "upload" sends every service its own HTTP copy of the input. "path" only sends the input's
+# path, for services on the same host or volume: uploads and frame batches are then stored in
+# SHARED_UPLOAD_DIR, which must be set to the same directory for the services.
+SERVICE_HANDOFF = os.getenv("SERVICE_HANDOFF", "upload")
+UPLOAD_DIR = os.getenv("SHARED_UPLOAD_DIR", "uploads")
 
+# Bump a service's version when its model or output changes, so cached results of the old one are not reused
+ANALYZER_VERSIONS = {
+    "crowd": os.getenv("CROWD_VERSION", "1"),
+    "environment": os.getenv("ENV_VERSION", "1"),
+    "emotion": os.getenv("EMOTION_VERSION", "1"),
+    "posture": os.getenv("BODY_VERSION", "1"),
+}
 
-        except Exception as e:
-            # This needs to be updated cuz what is this logic tsk tsk tsk
-            crowd_resp = {"error": f"Crowd service failed: {e}"}
-            environment_resp = {"error": f"Environment service failed: {e}"}
-            emotion_resp = {"error": f"Emotion service failed: {e}"}
-            posture_resp = {"error": f"Posture service failed: {e}"}
+# Per-service results, Gemini summaries and graphs of already seen videos, keyed by the video's hash
+result_cache = ResultCache(
+    os.getenv("RESULT_CACHE_DIR", os.path.join(os.path.dirname(__file__), "cache")),
+    int(os.getenv("RESULT_CACHE_MAX_MB", "512")) * 1024 * 1024,
+)
+
+# Picks the analyzers (and sampling rates) to run from the request's context, see selection.py.
+# Analyzers are then dropped, least useful first, until their estimated seconds fit in the
+# request's budget (the `budget` form field, or COMPUTE_BUDGET; 0 = no limit). Estimates
+# start from DEFAULT_COSTS and follow the measured service times.
+selection_policy = load_policy()
+cost_model = CostModel()
+COMPUTE_BUDGET = float(os.getenv("COMPUTE_BUDGET", "0"))
+
+# Result key -> (display name, video url, timeout in seconds). Timeouts can be tuned per service
+# since crowd analysis takes far longer than the environment model.
+SERVICES = {
+    "crowd": ("Crowd", CROWD_URL, float(os.getenv("CROWD_TIMEOUT", "300"))),
+    "environment": ("Environment", ENV_URL, float(os.getenv("ENV_TIMEOUT", "300"))),
+    "emotion": ("Emotion", EMOTION_URL, float(os.getenv("EMOTION_TIMEOUT", "300"))),
+    "posture": ("Posture", BODY_URL, float(os.getenv("BODY_TIMEOUT", "300"))),
+}
+
+
+# Services load their models in the background after starting and report it on /ready.
+# Before routing, the orchestrator waits up to SERVICE_READY_TIMEOUT seconds for a service
+# that is still loading (e.g. a replica that was just scaled up). A service that was ready
+# isn't checked again for READY_CACHE_SECONDS, unless a call to it fails.
+SERVICE_READY_TIMEOUT = float(os.getenv("SERVICE_READY_TIMEOUT", "60"))
+READY_CACHE_SECONDS = float(os.getenv("READY_CACHE_SECONDS", "30"))
+ready_since = {}  # service key -> time.monotonic() of its last ready answer
+# Services that have been ready once. If their probe times out, they are busy analyzing
+# rather than down, so they still get the request and queue it
+was_ready = set()
+
+
+def frames_url(url):
+    return url.replace("/analyze/", "/analyze_frames/")
+
+
+def ready_url(url):
+    return url.replace("/analyze/", "/ready")
+
+
+async def service_status(url):
+    """(ready, status dict) from a service's /ready."""
+    try:
+        resp = await http_client.get(ready_url(url), headers=request_headers(), timeout=5)
+        return resp.status_code == 200, resp.json()
+    except httpx.TimeoutException as e:
+        return False, {"status": "busy", "error": repr(e)}
+    except Exception as e:
+        return False, {"status": "unreachable", "error": repr(e)}
+
+
+async def wait_ready(key):
+    """None once the service is ready, or the error result to use instead of calling it."""
+    name, url, _ = SERVICES[key]
+    if time.monotonic() - ready_since.get(key, -READY_CACHE_SECONDS) < READY_CACHE_SECONDS:
+        return None
+    deadline = time.monotonic() + SERVICE_READY_TIMEOUT
+    while True:
+        ready, status = await service_status(url)
+        if ready:
+            ready_since[key] = time.monotonic()
+            was_ready.add(key)
+            return None
+        if status.get("status") == "busy" and key in was_ready:
+            return None
+        # Only a service that is up and still loading is worth waiting for
+        if status.get("status") != "loading" or time.monotonic() >= deadline:
+            return {"error": f"{name} service not ready: {status.get('error', status.get('status'))}"}
+        await asyncio.sleep(1)
+
+
+async def call_service(name, url, timeout, upload_path, filename, content_type, data=None):
+    """Uploads a file to one analyzer. Failures come back as an error dict so one
+    broken service never wipes out the other results."""
+    start = time.perf_counter()
+    outcome = "error"
+    # The request id lets a slow or failed call be found in the service's logs and metrics
+    headers = request_headers()
+    try:
+        if SERVICE_HANDOFF == "path":
+            data = {**(data or {}), "path": os.path.abspath(upload_path)}
+            resp = await http_client.post(url, data=data, headers=headers, timeout=timeout)
+        else:
+            # httpx streams the open file, it is never read into memory as a whole
+            with open(upload_path, "rb") as f:
+                files = {"file": (filename, f, content_type)}
+                resp = await http_client.post(url, files=files, data=data, headers=headers, timeout=timeout)
+        resp.raise_for_status()
+        result = resp.json()
+        outcome = "error" if "error" in result else "ok"
+        return result
+    except Exception as e:
+        return {"error": f"{name} service failed: {e!r}"}
+    finally:
+        SERVICE_SECONDS.observe(time.perf_counter() - start, target=name.lower(), outcome=outcome)
+
+
+async def timed(timings, key, call):
+    start = time.perf_counter()
+    try:
+        return await call
+    finally:
+        timings[key] = time.perf_counter() - start
+
+
+async def run_services(input_path, filename, content_type, services=None, schedules=None, timings=None):
+    """Runs the given analyzers (all by default) concurrently, so the total wait is roughly
+    that of the slowest one. Services that aren't ready get an error result instead.
+    `schedules` replaces some analyzers' sampling (frame pipeline and edge mode only), and
+    `timings` gets the seconds each analyzer took."""
+    keys = list(services or SERVICES)
+    timings = {} if timings is None else timings
+    if EDGE_MODE:
+        return await edge.run(input_path, keys, schedules, timings)
+    with stage("orchestrator", "readiness"):
+        errors = await asyncio.gather(*[wait_ready(key) for key in keys])
+    results = {key: error for key, error in zip(keys, errors) if error is not None}
+    ready = [key for key in keys if key not in results]
+    if ready:
+        results.update(await route_services(input_path, filename, content_type, ready, schedules, timings))
+    for key, result in results.items():
+        if "error" in result:
+            ready_since.pop(key, None)
+    return {key: results[key] for key in keys}
+
+
+async def route_services(input_path, filename, content_type, services, schedules, timings):
+    services = {key: SERVICES[key] for key in services}
+    if not FRAME_PIPELINE:
+        responses = await asyncio.gather(*[
+            timed(timings, key, call_service(name, url, timeout, input_path, filename, content_type))
+            for key, (name, url, timeout) in services.items()
+        ])
+        return dict(zip(services.keys(), responses))
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    batch_dir = tempfile.mkdtemp(prefix="frames_", dir=UPLOAD_DIR)
+    try:
+        with stage("orchestrator", "frame_extraction"):
+            fps, frame_count, batches = await asyncio.to_thread(
+                extract_frame_batches, input_path, batch_dir, list(services.keys()), schedules
+            )
+        data = {key: {"fps": str(fps), "frame_count": str(frame_count)} for key in services}
+        # A batch sampled at another rate than the default says so, the crowd service splits
+        # it into segments on window boundaries counted in sampled frames
+        for key, schedule in (schedules or {}).items():
+            if key in data:
+                data[key].update(sample_interval=str(schedule.interval(fps)), sample_offset=str(schedule.offset))
+        responses = await asyncio.gather(*[
+            timed(timings, key, call_service(name, frames_url(url), timeout, batches[key], f"{key}.frames",
+                                             "application/octet-stream", data[key]))
+            for key, (name, url, timeout) in services.items()
+        ])
+        return dict(zip(services.keys(), responses))
+    except Exception as e:
+        return {key: {"error": f"Frame extraction failed: {e!r}"} for key in services}
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+async def save_video(file):
+    """Streams the upload to UPLOAD_DIR in chunks, hashing it on the way. Returns (path, sha256)."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    hasher = hashlib.sha256()
+    # Named after the upload but made unique, jobs wait in the queue and two uploads of the
+    # same file name must not end up at the same path
+    stem = os.path.splitext(os.path.basename(file.filename or "video"))[0]
+    with stage("orchestrator", "upload"):
+        input_path = await save_upload(file, directory=UPLOAD_DIR, hasher=hasher,
+                                       prefix=f"{int(time.time())}_{stem}_")
+    return input_path, hasher.hexdigest()
+
+
+async def run_pipeline(progress, input_path, filename, content_type, context, video_hash=None, request_id=None,
+                       budget=None):
+    """Everything /process/ does for one stored upload, reporting progress as it goes."""
+    # Jobs run on the queue's workers, outside the request that submitted them
+    set_request_id(request_id)
+    with stage("orchestrator", "pipeline"):
+        return await _run_pipeline(progress, input_path, filename, content_type, context, video_hash, budget)
+
+
+async def _run_pipeline(progress, input_path, filename, content_type, context, video_hash, budget):
+    if video_hash is None:
+        await progress("hashing", 0.02)
+        with stage("orchestrator", "hashing"):
+            video_hash = await asyncio.to_thread(hash_file, input_path)
 
+    # The analyzers worth running for this context and their sampling rates. Rates can only
+    # be changed when the orchestrator samples the frames itself.
+    plan = complete_plan(selection_policy.choose(context, list(SERVICES)), list(SERVICES))
+    schedules = plan.schedules if FRAME_PIPELINE or EDGE_MODE else {}
+    fps, length = await asyncio.to_thread(source_info, ("video", input_path))
+    video_seconds = length / fps
+    factors = {key: rate_factor(key, schedules.get(key), fps) for key in plan.analyzers}
+
+    # Results only depend on the video, the analyzer versions and the sampling, so a
+    # re-submitted clip (e.g. with a different context) only re-runs what is missing from the cache
+    service_keys = {
+        key: make_key(key, ANALYZER_VERSIONS[key], video_hash, *([repr(schedules[key])] if key in schedules else []))
+        for key in plan.analyzers
+    }
+    service_results = {key: result_cache.get(k) for key, k in service_keys.items()}
+    cached = [key for key, result in service_results.items() if result is not None]
+    # Cached results are free, the others have to fit in the budget
+    budget = COMPUTE_BUDGET if budget is None else budget
+    estimates = {
+        key: 0.0 if key in cached else cost_model.estimate(key, video_seconds, factors[key])
+        for key in plan.analyzers
+    }
+    selected, over_budget = fit_budget(plan.analyzers, estimates, budget)
+    skipped = {**plan.skipped, **over_budget}
+    missing = [key for key in selected if key not in cached]
+    if missing:
+        await progress("analyzing", 0.05)
+        timings = {}
+        fresh = await run_services(input_path, filename, content_type, missing, schedules, timings)
+        for key, result in fresh.items():
+            if "error" not in result:
+                result_cache.put(service_keys[key], result)
+                cost_model.observe(key, timings[key], video_seconds, factors[key])
+        service_results.update(fresh)
+    # Skipped analyzers keep their place in the output, with the reason instead of results
+    service_results.update({key: {"skipped": reason} for key, reason in skipped.items()})
+    crowd_resp = service_results.get("crowd")
+    environment_resp = service_results.get("environment")
+    emotion_resp = service_results.get("emotion")
+    posture_resp = service_results.get("posture")
 
     combined_output = {
         "timestamp": datetime.now().isoformat(),
@@ -73,13 +342,27 @@ async def process(file: UploadFile, context: str = Form(...)):
     with open(json_path, "w") as f:
         json.dump(combined_output, f, indent=2)
 
-    try:
-        gemini_analysis = analyze_with_gemini(combined_output)
-        print(gemini_analysis)
-    except Exception as e:
-        gemini_analysis = {"error": f"Gemini failed: {e}"}
+    results_key = make_key(video_hash, sorted(service_keys[key] for key in selected))
+    # Summaries and graphs built on a failed service are not worth keeping
+    complete = all("error" not in result for result in service_results.values())
+    gemini_key = make_key("gemini", results_key, context)
+    gemini_analysis = result_cache.get(gemini_key)
+    if gemini_analysis is None:
+        await progress("summarizing", 0.8)
+        try:
+            with stage("orchestrator", "gemini"):
+                gemini_analysis = await analyze_with_gemini_async(combined_output)
+            if complete and "error" not in gemini_analysis:
+                result_cache.put(gemini_key, gemini_analysis)
+        except Exception as e:
+            gemini_analysis = {"error": f"Gemini failed: {e}"}
 
-    graphs = generate_graphs(combined_output) 
+    # Graphs only depend on the service results, so complete results share one set per video.
+    # Only the chart data is written here, the images are drawn when first requested.
+    graph_id = results_key[:16] if complete else uuid.uuid4().hex[:16]
+    await asyncio.to_thread(save_series, combined_output, os.path.join(graphs_path, graph_id))
+    graphs = {name: f"graphs/{graph_id}/{filename}" for name, filename in GRAPH_FILES.items()}
+    graphs["series"] = f"graphs/{graph_id}/series"
     
     # # === Alert ===
     # if "anomaly" in gemini_analysis.get("summary", "").lower():
@@ -91,5 +374,149 @@ async def process(file: UploadFile, context: str = Form(...)):
         "results": combined_output,
         "gemini": gemini_analysis,
         "graphs": graphs,
+        "cached": cached,
+        "selection": {
+            "rule": plan.rule,
+            "analyzers": selected,
+            "skipped": skipped,
+            "sampling": {key: repr(schedule) for key, schedule in schedules.items() if key in selected},
+            "budget_seconds": budget or None,
+            "estimated_seconds": {key: round(estimates[key], 2) for key in selected},
+        },
+    }
+
+
+# Analyses are queued and run by a fixed pool of workers. When the queue is full, new uploads
+# get a 429 instead of piling up until everything times out.
+job_queue = JobQueue(
+    run_pipeline,
+    workers=int(os.getenv("JOB_WORKERS", "4")),
+    max_queued=int(os.getenv("JOB_QUEUE_SIZE", "16")),
+)
+
+
+async def submit_job(file, context, budget=None):
+    # The slot is taken before the upload is written and hashed, a full queue turns it away
+    # without reading it
+    try:
+        with job_queue.reserve():
+            input_path, video_hash = await save_video(file)
+            return job_queue.submit(input_path=input_path, filename=file.filename,
+                                    content_type=file.content_type, context=context, video_hash=video_hash,
+                                    request_id=current_request_id(), budget=budget)
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Too many videos queued, try again later",
+                            headers={"Retry-After": "30"})
+
+
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@app.post("/process/")
+async def process(file: UploadFile, context: str = Form(...), budget: float = Form(None)):
+    """Analyzes a video and waits for the result. Long videos should use /jobs/ instead.
+    `budget` caps the estimated analyzer seconds spent on it."""
+    job = await submit_job(file, context, budget)
+    async for _ in job.watch():
+        pass
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    return job.result
+
+
+@app.post("/jobs/", status_code=202)
+async def create_job(file: UploadFile, context: str = Form(...), budget: float = Form(None)):
+    """Queues a video for analysis and returns right away. Poll /jobs/{id} (or stream
+    /jobs/{id}/events) for progress, then fetch /jobs/{id}/result."""
+    job = await submit_job(file, context, budget)
+    return {
+        **job.snapshot(),
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+        "result_url": f"/jobs/{job.id}/result",
     }
 
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).snapshot()
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """NDJSON stream of status updates, ending when the job finishes."""
+    job = get_job(job_id)
+
+    async def body():
+        async for snapshot in job.watch():
+            yield json.dumps(snapshot) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_job(job_id)
+    if job.status == "failed":
+        return JSONResponse(status_code=500, content=job.snapshot())
+    if not job.done:
+        return JSONResponse(status_code=409, content=job.snapshot())
+    return job.result
+
+
+@app.get("/jobs/")
+async def jobs_stats():
+    return job_queue.stats()
+
+
+def graph_dir(graph_id):
+    out_dir = os.path.join(graphs_path, graph_id)
+    if not re.fullmatch(r"[0-9a-f]{16}", graph_id) or not os.path.exists(os.path.join(out_dir, SERIES_FILE)):
+        raise HTTPException(status_code=404, detail="Unknown graphs")
+    return out_dir
+
+
+@app.get("/graphs/{graph_id}/series")
+async def graph_series(graph_id: str):
+    """The data behind the charts, for drawing them client-side instead of loading the PNGs."""
+    return await asyncio.to_thread(load_series, graph_dir(graph_id))
+
+
+@app.get("/graphs/{graph_id}/{filename}")
+async def graph_image(graph_id: str, filename: str):
+    names = {f: name for name, f in GRAPH_FILES.items()}
+    if filename not in names:
+        raise HTTPException(status_code=404, detail="Unknown graph")
+    with stage("orchestrator", "graph_render"):
+        path = await asyncio.get_running_loop().run_in_executor(
+            graph_executor, render_graph, graph_dir(graph_id), names[filename]
+        )
+    return FileResponse(path, media_type="image/png")
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "service": "orchestrator"}
+
+
+@app.get("/ready")
+async def ready():
+    """Ready when every analyzer service is (checked now, without waiting for them)."""
+    if EDGE_MODE:
+        statuses = [(edge.models[key].ready, edge.models[key].status()) for key in SERVICES]
+    else:
+        statuses = await asyncio.gather(*[service_status(url) for _, url, _ in SERVICES.values()])
+    services = {key: status for key, (_, status) in zip(SERVICES, statuses)}
+    all_ready = all(ok for ok, _ in statuses)
+    return JSONResponse({"status": "ready" if all_ready else "not ready", "services": services},
+                        status_code=200 if all_ready else 503)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
@@ -0,0 +1,147 @@
+"""Edge mode: every analyzer runs inside the orchestrator process instead of as an HTTP service.
+
+For a single box in front of a few cameras, where five processes exchanging uploads and JSON
+cost more memory and CPU than the analysis itself. The video is decoded once and every frame
+goes straight to the analyzers whose schedule wants it, each analyzer consuming its frames on
+its own thread through a small bounded queue. The results are the same as the services'
+/analyze/ ones, so the rest of the pipeline doesn't know the difference.
+"""
+import asyncio
+import importlib
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+from common.frames import FrameSampler, SCHEDULES
+from common.metrics import stage
+
+# Frames decoded ahead of each analyzer. The decoder waits for the slowest one when its
+# queue is full, so this bounds memory per video
+QUEUE_FRAMES = int(os.getenv("EDGE_QUEUE_FRAMES", "16"))
+
+# Result key -> (service directory, module)
+MODULES = {
+    "crowd": ("crowd_service", "crowd_analyser"),
+    "environment": ("env_service", "envir_analyzer"),
+    "emotion": ("emotion_service", "emo_analyzer"),
+    "posture": ("body_service", "body_analyzer"),
+}
+
+
+def import_analyzer(key):
+    directory, module = MODULES[key]
+    path = os.path.join(ROOT, directory)
+    if path not in sys.path:
+        sys.path.append(path)
+    return importlib.import_module(module)
+
+
+crowd = import_analyzer("crowd")
+environment = import_analyzer("environment")
+emotion = import_analyzer("emotion")
+posture = import_analyzer("posture")
+
+# Each service's frame-level analysis, called with an iterator of (frame_idx, frame) pairs and
+# the sampler feeding it. Emotion reports how far into the video the sampler got, which is
+# only known once its frames run out.
+RUNNERS = {
+    "crowd": lambda frames, sampler: crowd.analyse_frames(frames),
+    "environment": lambda frames, sampler: environment.analyze_frames(frames, sampler.fps),
+    "emotion": lambda frames, sampler: emotion.summarize(emotion.analyze_frames(frames), sampler.frames_read),
+    "posture": lambda frames, sampler: posture.analyze_frames(frames),
+}
+
+models = {
+    "crowd": crowd.models,
+    "environment": environment.models,
+    "emotion": emotion.models,
+    "posture": posture.models,
+}
+
+_END = object()
+
+
+class FrameFeed:
+    """Frames for one analyzer, handed over from the decode loop through a bounded queue."""
+
+    def __init__(self, size=QUEUE_FRAMES):
+        self.queue = queue.Queue(maxsize=size)
+        self.done = False  # set once the analyzer stops reading, e.g. after an error
+
+    def put(self, item):
+        while not self.done:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self.put(_END)
+
+    def __iter__(self):
+        while (item := self.queue.get()) is not _END:
+            yield item
+
+
+def _consume(key, feed, sampler, timings):
+    start = time.perf_counter()
+    try:
+        return RUNNERS[key](feed, sampler)
+    except Exception as e:
+        return {"error": f"{key} analysis failed: {e!r}"}
+    finally:
+        feed.done = True
+        timings[key] = time.perf_counter() - start
+
+
+def analyze_video(video_path, services, schedules=None, timings=None):
+    """Decodes the video once and feeds every analyzer the frames its schedule (or its entry
+    in `schedules`) wants, each on its own thread. Returns {service: result}, and fills
+    `timings` with each analyzer's seconds."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video file: {video_path}")
+
+    schedules = {key: (schedules or {}).get(key, SCHEDULES[key]) for key in services}
+    timings = {} if timings is None else timings
+    sampler = FrameSampler(cap, list(schedules.values()))
+    feeds = {key: FrameFeed() for key in services}
+    with ThreadPoolExecutor(max_workers=len(services), thread_name_prefix="edge") as pool:
+        futures = {key: pool.submit(_consume, key, feeds[key], sampler, timings) for key in services}
+        try:
+            for frame_idx, frame in sampler:
+                for key, feed in feeds.items():
+                    if schedules[key].wants(frame_idx, sampler.fps):
+                        feed.put((frame_idx, frame))
+        finally:
+            cap.release()
+            for feed in feeds.values():
+                feed.close()
+        return {key: future.result() for key, future in futures.items()}
+
+
+def start():
+    """Starts loading every analyzer's models in the background, like the services do."""
+    for loader in models.values():
+        loader.start()
+
+
+async def run(video_path, services, schedules=None, timings=None):
+    """Same as calling the services' /analyze/ endpoints: {service: result or error dict}."""
+    errors = await asyncio.gather(*[models[key].wait() for key in services], return_exceptions=True)
+    results = {key: {"error": str(e)} for key, e in zip(services, errors) if e is not None}
+    ready = [key for key in services if key not in results]
+    if ready:
+        try:
+            with stage("orchestrator", "edge_analysis"):
+                results.update(await asyncio.to_thread(analyze_video, video_path, ready, schedules, timings))
+        except Exception as e:
+            results.update({key: {"error": f"Edge analysis failed: {e!r}"} for key in ready})
+    return {key: results[key] for key in services}
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import cv2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.frames import FrameSampler, SCHEDULES
+from common.frame_batch import FrameBatchWriter, encode_frame
+
+JPEG_QUALITY = int(os.getenv("FRAME_JPEG_QUALITY", "90"))
+
+
+def extract_frame_batches(video_path, out_dir, services, schedules=None):
+    """Decodes the video once and writes one frame batch per service, holding only the
+    frames that service samples. Frames wanted by several services are encoded once.
+    `schedules` can replace some services' default schedules.
+
+    Returns (fps, frame_count, {service: batch path}).
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Failed to open video file: {video_path}")
+
+    schedules = {s: (schedules or {}).get(s, SCHEDULES[s]) for s in services}
+    sampler = FrameSampler(cap, list(schedules.values()))
+    writers = {s: FrameBatchWriter(os.path.join(out_dir, f"{s}.frames")) for s in services}
+    try:
+        for frame_idx, frame in sampler:
+            payload = encode_frame(frame, JPEG_QUALITY)
+            for s, schedule in schedules.items():
+                if schedule.wants(frame_idx, sampler.fps):
+                    writers[s].write(frame_idx, payload)
+    finally:
+        cap.release()
+        for w in writers.values():
+            w.close()
+
+    return sampler.fps, sampler.frames_read, {s: w.path for s, w in writers.items()}
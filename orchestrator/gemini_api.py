@@ -1,29 +1,157 @@
+import asyncio
 import json
 import os
-import requests
+from collections import Counter
 from datetime import datetime
 
-import google.generativeai as genai
-import os
 from dotenv import load_dotenv
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+# "gemini" calls the API, "stub" builds a summary locally (offline runs and tests)
+BACKEND = os.getenv("GEMINI_BACKEND", "gemini")
+MODEL_NAME = os.getenv("GEMINI_MODEL", "models/gemini-2.5-flash")
+# Rough upper bound on the prompt size (~4 characters per token)
+TOKEN_BUDGET = int(os.getenv("GEMINI_TOKEN_BUDGET", "2000"))
+
+INSTRUCTIONS = """You are an AI analysis system working to provide insights on data collected from surveillance video analysis.
+Summarize the crowd, emotion, posture, and environment data below into concise insights.
+Explain correlations, trends, and possible causes in human terms. Provide everything in bullet points, and make the response readable."""
+
+_model = None
+
+
+def get_model():
+    """The GenerativeModel is created once and reused by every request."""
+    global _model
+    if _model is None:
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        _model = genai.GenerativeModel(MODEL_NAME)
+    return _model
+
+
+def _round(value):
+    return round(float(value), 3)
+
+
+def summarize_crowd(crowd, top_zones, timeline_points):
+    windows = crowd.get("aggregated_outputs", [])
+    if not windows:
+        return {"error": crowd["error"]} if "error" in crowd else {}
+    zones = windows[0]["aggregate"].keys()
+    people = {z: [w["aggregate"][z]["avg_people"] for w in windows] for z in zones}
+    busiest = sorted(zones, key=lambda z: -max(people[z]))[:top_zones]
+    insights = Counter(w["aggregate"][z]["dominant_insight"] for w in windows for z in zones)
+    states = Counter(w["aggregate"][z]["dominant_state"] for w in windows for z in zones)
+
+    # Total people per window, thinned out to at most `timeline_points` evenly spaced points
+    totals = [(w["frame_window"][0], _round(sum(w["aggregate"][z]["avg_people"] for z in zones))) for w in windows]
+    step = max(1, -(-len(totals) // timeline_points))
+    return {
+        "windows": len(windows),
+        "busiest_zones": {
+            z: {"mean_people": _round(sum(people[z]) / len(people[z])), "peak_people": _round(max(people[z]))}
+            for z in busiest
+        },
+        "zone_states": dict(states),
+        "zone_insights": dict(insights),
+        "people_timeline": totals[::step],
+    }
+
+
+def summarize_environment(env):
+    if "error" in env:
+        return {"error": env["error"]}
+    changes = []
+    prev = None
+    for r in env.get("frame_results", []):
+        current = {k: v for k, v in r.items() if k not in ("frame", "inferred")}
+        if prev is not None and current != prev:
+            changes.append({"frame": r.get("frame"), **{k: v for k, v in current.items() if prev.get(k) != v}})
+        prev = current
+    return {"overall": env.get("aggregated_environment", {}), "changes": changes}
+
+
+def summarize_emotion(emotion):
+    # Per-track timelines grow with the video, only their number is kept
+    summary = {k: v for k, v in emotion.items() if k != "tracks"}
+    if "tracks" in emotion:
+        summary["tracked_people"] = len(emotion["tracks"])
+    return summary
+
+
+def summarize_posture(posture):
+    if "error" in posture:
+        return {"error": posture["error"]}
+    persons = [p for f in posture.get("frame_results", []) for p in f.get("persons", [])]
+    return {
+        "overall": posture.get("aggregated_posture_bodylang", {}),
+        "postures": dict(Counter(p["posture"] for p in persons)),
+        "body_language": dict(Counter(p["body_language"] for p in persons)),
+    }
+
+
+def compact_results(results, top_zones=5, timeline_points=12):
+    """Summary statistics of the combined output, without per-frame results. Analyzers that
+    were skipped for this request only keep the reason."""
+    summarizers = {
+        "crowd": lambda r: summarize_crowd(r, top_zones, timeline_points),
+        "environment": summarize_environment,
+        "emotion": summarize_emotion,
+        "posture": summarize_posture,
+    }
+    compact = {"context": results.get("context")}
+    for key, summarize in summarizers.items():
+        result = results.get(key, {})
+        compact[key] = {"skipped": result["skipped"]} if "skipped" in result else summarize(result)
+    return compact
+
+
+def build_prompt(results, token_budget=TOKEN_BUDGET):
+    """Prompt with compact statistics, shrunk until it fits in `token_budget` tokens
+    whatever the length of the video."""
+    max_chars = token_budget * 4
+    for top_zones, timeline_points in ((5, 12), (3, 6), (1, 3)):
+        data = json.dumps(compact_results(results, top_zones, timeline_points), separators=(",", ":"))
+        prompt = f"{INSTRUCTIONS}\nData: {data}"
+        if len(prompt) <= max_chars:
+            return prompt
+    return prompt[:max_chars]
+
+
+def stub_summary(results):
+    """Deterministic bullet points from the compact statistics, no network needed."""
+    stats = compact_results(results)
+    lines = [f"- Context: {stats['context']}"]
+    crowd = stats["crowd"]
+    if crowd.get("busiest_zones"):
+        zone, z = next(iter(crowd["busiest_zones"].items()))
+        lines.append(f"- Busiest zone {zone}: {z['mean_people']} people on average, peak {z['peak_people']}")
+    env = stats["environment"].get("overall")
+    if env:
+        lines.append("- Environment: " + ", ".join(f"{k} {v}" for k, v in env.items()))
+    if stats["emotion"].get("dominant_emotion"):
+        lines.append(f"- Dominant emotion: {stats['emotion']['dominant_emotion']}")
+    posture = stats["posture"].get("overall")
+    if posture:
+        lines.append(f"- Posture: {posture.get('posture')}, body language: {posture.get('body_language')}")
+    return "\n".join(lines)
+
 
 def analyze_with_gemini(results):
-    prompt = f"""
-    You are an AI analysis system working to provide insights on data collected from surveillance video analysis.
-    Summarize the crowd, emotion, posture, and environment data below into concise insights.
-    Explain correlations, trends, and possible causes in human terms. Provide everything in bullet points, and make the response readable.
-    Data: {json.dumps(results, indent=2)}
-    """
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
+    if BACKEND == "stub":
+        return {"summary": stub_summary(results), "timestamp": str(datetime.now())}
 
-    response = model.generate_content(prompt)
-    print(response)
+    response = get_model().generate_content(build_prompt(results))
 
     if response.text:
         text = response.text
         return {"summary": text, "timestamp": str(datetime.now())}
     else:
-        return {"summary": "Error generating insights.", "error": text}
\ No newline at end of file
+        return {"summary": "Error generating insights.", "error": "Empty response from Gemini"}
+
+
+async def analyze_with_gemini_async(results):
+    """Runs the (blocking) Gemini call in a thread so the event loop keeps serving requests."""
+    return await asyncio.to_thread(analyze_with_gemini, results)
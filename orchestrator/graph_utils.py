@@ -1,82 +1,134 @@
-import matplotlib.pyplot as plt
+import numpy as np
+import json
 import os
+import threading
+
+# Figures are built with the object-oriented API (no pyplot global state), so several
+# threads can render at the same time. Each file is written under a temporary name and
+# renamed, so a half-written chart is never served. matplotlib is only imported when a chart
+# is first drawn, so it doesn't slow down startup.
+
+GRAPH_FILES = {
+    "crowd_graph": "crowd_activity.png",
+    "environment_graph": "environment_factors.png",
+}
+SERIES_FILE = "series.json"
+
+
+def graph_series(data):
+    """The numbers behind the charts, also served as JSON so the frontend can draw them itself."""
+    aggregated = data.get("crowd", {}).get("aggregated_outputs", [])
+    zones = sorted(aggregated[0]["aggregate"].keys()) if aggregated else []
+    return {
+        "crowd": {
+            "zones": zones,
+            "frame_windows": [a["frame_window"] for a in aggregated],
+            "avg_people": [[float(a["aggregate"][z]["avg_people"]) for z in zones] for a in aggregated],
+        },
+        "environment": data.get("environment", {}).get("aggregated_environment", {}),
+    }
+
+
+def _tmp_path(path):
+    # Unique per process and thread, two requests rendering the same chart don't share it
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def _save(fig, path):
+    tmp = _tmp_path(path)
+    fig.savefig(tmp, format="png")
+    os.replace(tmp, path)
+
+
+def _placeholder(path, title, message):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.text(0.5, 0.5, message, ha="center", va="center")
+    ax.set_title(title)
+    _save(fig, path)
+
+
+def render_crowd_graph(series, path):
+    crowd = series["crowd"]
+    if not crowd["avg_people"]:
+        _placeholder(path, "Crowd Activity Levels", "No crowd data available")
+        return
+
+    zones = crowd["zones"]
+    x = np.arange(len(zones))
+    width = 0.35
+
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(12, 6))
+    ax = fig.add_subplot()
+    for i, (window, values) in enumerate(zip(crowd["frame_windows"], crowd["avg_people"])):
+        ax.bar(x + i * width, values, width, label=f"Frames {window[0]}–{window[1]}")
+
+    ax.set_xlabel("Zones")
+    ax.set_ylabel("Average People")
+    ax.set_title("Crowd Activity by Zone and Frame Window")
+    ax.set_xticks(x + width / 2)
+    ax.set_xticklabels(zones)
+    ax.legend()
+    fig.tight_layout()
+    _save(fig, path)
+
+
+def render_environment_graph(series, path):
+    env_agg = series["environment"]
+    if not env_agg:
+        _placeholder(path, "Environment Factor Trends", "No environment data available")
+        return
 
-def generate_graphs(data):
-    os.makedirs("outputs/graphs", exist_ok=True)
-    graphs = {}
-
-    crowd = data.get("crowd", {})
-    aggregated = crowd.get("aggregated_outputs", [])
-    print(aggregated)
-
-    if not aggregated:
-        plt.figure()
-        plt.text(0.5, 0.5, "No crowd data available", ha="center", va="center")
-        plt.title("Crowd Activity Levels")
-        cpath = "outputs/graphs/crowd_activity.png"
-        plt.savefig(cpath)
-        plt.close()
-        graphs["crowd_graph"] = cpath
-    else:
-        zones = sorted(list(aggregated[0]["aggregate"].keys()))
-
-        frame_labels = [f"{a['frame_window'][0]}–{a['frame_window'][1]}" for a in aggregated]
-        values = []
-        for agg in aggregated:
-            vals = [agg["aggregate"][z]["avg_people"] for z in zones]
-            values.append(vals)
-
-        import numpy as np
-        x = np.arange(len(zones))
-        width = 0.35
-
-        plt.figure(figsize=(12, 6))
-        for i, frame in enumerate(frame_labels):
-            plt.bar(x + i * width, values[i], width, label=f"Frames {frame}")
-
-        plt.xlabel("Zones")
-        plt.ylabel("Average People")
-        plt.title("Crowd Activity by Zone and Frame Window")
-        plt.xticks(x + width / 2, zones)
-        plt.legend()
-        plt.tight_layout()
-
-        cpath = "outputs/graphs/crowd_activity.png"
-        plt.savefig(cpath)
-        plt.close()
-        graphs["crowd_graph"] = cpath
-    
-    env_data = data.get("environment", {})
-    env_agg = env_data.get("aggregated_environment", {})
-    env_path = "outputs/graphs/environment_factors.png"
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(8, 4))
+    ax = fig.add_subplot()
+    ax.axis('off')
+    ax.set_title("Environmental Factors Overview", fontsize=14, weight='bold')
 
-    if not env_agg:
-        plt.figure()
-        plt.text(0.5, 0.5, "No environment data available", ha="center", va="center")
-        plt.title("Environment Factor Trends")
-        plt.savefig(env_path)
-        plt.close()
-        graphs["environment_graph"] = env_path
-    else:
-        factors = list(env_agg.keys())
-        values = list(env_agg.values())
-
-        # Convert categorical labels (like "sunny", "day", etc.) to numeric codes for plotting
-        unique_labels = {val: i for i, val in enumerate(sorted(set(values)))}
-        numeric_values = [unique_labels[val] for val in values]
-
-        plt.figure(figsize=(8, 4))
-        plt.axis('off')
-        plt.title("Environmental Factors Overview", fontsize=14, weight='bold')
-
-        for i, (factor, value) in enumerate(env_agg.items()):
-            plt.text(0, 1 - i*0.2, f"{factor.capitalize()}: {value}", fontsize=12)
-
-        plt.tight_layout()
-        plt.savefig("outputs/graphs/environment_factors.png")
-        plt.close()
-
-        graphs["environment_graph"] = env_path
+    for i, (factor, value) in enumerate(env_agg.items()):
+        ax.text(0, 1 - i*0.2, f"{factor.capitalize()}: {value}", fontsize=12)
+
+    fig.tight_layout()
+    _save(fig, path)
+
+
+RENDERERS = {
+    "crowd_graph": render_crowd_graph,
+    "environment_graph": render_environment_graph,
+}
+
+
+def save_series(data, out_dir):
+    """Writes the chart data only. PNGs are drawn later by render_graph, when first requested."""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, SERIES_FILE)
+    if not os.path.exists(path):
+        tmp = _tmp_path(path)
+        with open(tmp, "w") as f:
+            json.dump(graph_series(data), f)
+        os.replace(tmp, path)
+    return path
+
+
+def load_series(out_dir):
+    with open(os.path.join(out_dir, SERIES_FILE)) as f:
+        return json.load(f)
+
+
+def render_graph(out_dir, name):
+    """Draws one chart from the saved series unless it already exists, returns its path."""
+    path = os.path.join(out_dir, GRAPH_FILES[name])
+    if not os.path.exists(path):
+        RENDERERS[name](load_series(out_dir), path)
+    return path
+
+
+def generate_graphs(data, out_dir="outputs/graphs"):
+    """Renders every chart right away."""
+    save_series(data, out_dir)
+    graphs = {name: render_graph(out_dir, name) for name in GRAPH_FILES}
 
     # === PLACEHOLDERS FOR FUTURE GRAPHS ===
     # # Emotion Trends Graph
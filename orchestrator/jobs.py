@@ -0,0 +1,136 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kwargs):
+        self.id = uuid.uuid4().hex
+        self.kwargs = kwargs
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.version = 0  # bumped on every update, lets subscribers tell if they missed one
+        self.changed = asyncio.Condition()
+
+    @property
+    def done(self):
+        return self.status in ("done", "failed")
+
+    def snapshot(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+    async def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.version += 1
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def watch(self):
+        """Yields a snapshot now and after every update, until the job is finished."""
+        seen = None
+        while True:
+            if self.version != seen:
+                seen = self.version
+                yield self.snapshot()
+                if self.done:
+                    return
+                continue
+            async with self.changed:
+                await self.changed.wait()
+
+
+class JobQueue:
+    """Bounded queue of jobs drained by a fixed number of worker tasks. `handler(progress, **kwargs)`
+    does the actual work, `progress(stage, fraction)` reports how far along it is."""
+
+    def __init__(self, handler, workers=4, max_queued=16, max_kept=1000):
+        self.handler = handler
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.max_kept = max_kept
+        self.jobs = OrderedDict()
+        self.tasks = []
+        self.reserved = 0  # slots held by reserve() for jobs whose input is still being received
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    @contextmanager
+    def reserve(self):
+        """Holds a queue slot for a job that is about to be submitted, so its upload is only read
+        once there is room for it. Raises QueueFull when every slot is taken."""
+        if self.queue.qsize() + self.reserved >= self.queue.maxsize:
+            raise QueueFull()
+        self.reserved += 1
+        try:
+            yield
+        finally:
+            self.reserved -= 1
+
+    def submit(self, **kwargs):
+        """Queues a job, raises QueueFull when the queue is at capacity."""
+        job = Job(kwargs)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull()
+        self.jobs[job.id] = job
+        self._forget_old()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stats(self):
+        running = sum(1 for j in self.jobs.values() if j.status == "running")
+        return {"queued": self.queue.qsize(), "running": running, "workers": self.workers,
+                "reserved": self.reserved,
+                "max_queued": self.queue.maxsize}
+
+    def _forget_old(self):
+        # Oldest finished jobs go first, jobs still queued or running are always kept
+        for job_id in [i for i, j in self.jobs.items() if j.done][:max(0, len(self.jobs) - self.max_kept)]:
+            del self.jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            await job.update(status="running", stage="starting", started=time.time())
+
+            async def progress(stage, fraction, job=job):
+                await job.update(stage=stage, progress=fraction)
+
+            try:
+                result = await self.handler(progress, **job.kwargs)
+                await job.update(status="done", stage="done", progress=1.0, result=result, finished=time.time())
+            except Exception as e:
+                await job.update(status="failed", error=repr(e), finished=time.time())
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,130 @@
+"""Which analyzers to run for a request.
+
+A policy reads the request's context and returns a Plan: the analyzers worth running, most
+useful first, sampling rates that differ from the defaults, and why the other analyzers are
+left out. RulePolicy does this from a table of context keywords. A learned policy can replace
+it. It only needs a `choose(context, candidates)` method, loaded with
+SELECTION_POLICY=module:attribute.
+
+fit_budget then drops the least useful analyzers whose estimated cost doesn't fit in the
+request's compute budget. The estimates come from a CostModel of measured service times.
+"""
+import importlib
+import json
+import os
+import re
+import threading
+
+from common.frames import Schedule, SCHEDULES
+
+# Context keywords -> analyzers to run, most useful first. "sampling" overrides an analyzer's
+# schedule with one frame every N seconds. The first matching rule wins; contexts matching no
+# rule get every analyzer. SELECTION_RULES can point at a JSON file with the same structure.
+DEFAULT_RULES = [
+    {"name": "classroom", "keywords": ["classroom", "lecture", "school", "exam", "students"],
+     "analyzers": ["emotion", "posture", "crowd"]},
+    {"name": "mall", "keywords": ["mall", "shop", "store", "retail", "market", "station", "airport"],
+     "analyzers": ["crowd", "environment", "emotion"]},
+    {"name": "office", "keywords": ["office", "meeting", "workplace", "desk", "coworking"],
+     "analyzers": ["posture", "emotion", "environment"]},
+    {"name": "rehab", "keywords": ["rehab", "rehabilitation", "physio", "physiotherapy", "therapy", "patient"],
+     "analyzers": ["posture", "emotion"], "sampling": {"posture": 1}},
+]
+
+# Analyzer seconds per second of video at the default sampling rates, used until calls have
+# been measured
+DEFAULT_COSTS = {"crowd": 0.5, "environment": 0.05, "emotion": 0.5, "posture": 0.1}
+
+
+class Plan:
+    def __init__(self, analyzers, schedules=None, skipped=None, rule=None):
+        self.analyzers = analyzers         # keys, most useful first
+        self.schedules = schedules or {}   # key -> Schedule replacing SCHEDULES[key]
+        self.skipped = skipped or {}       # key -> reason
+        self.rule = rule                   # name of the rule that matched, if any
+
+
+class RulePolicy:
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = rules
+
+    def choose(self, context, candidates):
+        words = set(re.findall(r"[a-z]+", (context or "").lower()))
+        for rule in self.rules:
+            if words & set(rule["keywords"]):
+                chosen = [key for key in rule["analyzers"] if key in candidates]
+                skipped = {key: f"not relevant for {rule['name']} contexts" for key in candidates if key not in chosen}
+                schedules = {key: Schedule(seconds=seconds) for key, seconds in rule.get("sampling", {}).items()
+                             if key in chosen}
+                return Plan(chosen, schedules, skipped, rule["name"])
+        return Plan(list(candidates))
+
+
+def complete_plan(plan, candidates):
+    """Keeps only the candidates among a policy's analyzers and gives every candidate it left
+    out a skip reason, so a policy only has to list what to run."""
+    plan.analyzers = [key for key in dict.fromkeys(plan.analyzers) if key in candidates]
+    plan.schedules = {key: schedule for key, schedule in plan.schedules.items() if key in plan.analyzers}
+    plan.skipped = {key: plan.skipped.get(key, "not selected by policy")
+                    for key in candidates if key not in plan.analyzers}
+    return plan
+
+
+def load_policy():
+    """The policy named by SELECTION_POLICY (module:attribute, a class or an instance), or a
+    RulePolicy over SELECTION_RULES / DEFAULT_RULES."""
+    name = os.getenv("SELECTION_POLICY")
+    if name:
+        module, _, attr = name.partition(":")
+        policy = getattr(importlib.import_module(module), attr)
+        return policy() if isinstance(policy, type) else policy
+    path = os.getenv("SELECTION_RULES")
+    if path:
+        with open(path) as f:
+            return RulePolicy(json.load(f))
+    return RulePolicy()
+
+
+def rate_factor(key, schedule, fps):
+    """How many more frames `schedule` samples than the analyzer's default one."""
+    if schedule is None:
+        return 1.0
+    return SCHEDULES[key].interval(fps) / schedule.interval(fps)
+
+
+class CostModel:
+    """Analyzer seconds per second of video at the default sampling rate, as an exponential
+    moving average of measured calls."""
+
+    def __init__(self, priors=DEFAULT_COSTS, alpha=0.3):
+        self.costs = dict(priors)
+        self.alpha = alpha
+        self.lock = threading.Lock()
+
+    def estimate(self, key, video_seconds, factor=1.0):
+        return self.costs.get(key, 0.0) * video_seconds * factor
+
+    def observe(self, key, seconds, video_seconds, factor=1.0):
+        if video_seconds <= 0:
+            return
+        measured = seconds / video_seconds / factor
+        with self.lock:
+            previous = self.costs.get(key)
+            self.costs[key] = measured if previous is None else (1 - self.alpha) * previous + self.alpha * measured
+
+
+def fit_budget(analyzers, estimates, budget):
+    """Keeps analyzers, most useful first, while their estimated seconds fit in `budget`
+    (None or 0 is no limit). A cheaper analyzer further down may still fit after an expensive
+    one was dropped. Returns (kept, {dropped: reason})."""
+    kept, dropped = [], {}
+    left = budget
+    for key in analyzers:
+        cost = estimates[key]
+        if not budget or cost <= left:
+            kept.append(key)
+            if budget:
+                left -= cost
+        else:
+            dropped[key] = f"over budget: estimated {cost:.3g}s with {left:.3g}s of {budget:.3g}s left"
+    return kept, dropped